@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from benchmarks.bench import main
+
+main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import click
+import socket
+import platform
+import tempfile
+import subprocess
+import simplejson
+import http.client
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from benchmarks.generate import write_dataset, write_errata
+
+
+# Benchmarks of a real server process against synthetic data
+#
+# Every dataset size gets a fresh server started with `python -m
+# errata_server`. Reload stage durations are read from its /metrics, memory
+# from /proc, and all queries go through HTTP on localhost. Results are
+# written as JSON, and two result files can be compared with `compare`.
+
+RESULT_FORMAT = 1
+OPERATINGSYSTEM = 'debian'
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def query_mix(releases: int) -> Dict[str, Tuple[str, Dict[str, str]]]:
+    some_releases = ','.join('release{}'.format(number) for number in range(min(3, releases)))
+    return {
+        'all': ('', {}),
+        'release': ('releases=release0', {}),
+        'release+component': ('releases=release0&components=main', {}),
+        'katello': ('releases=release0/updates&components=main,contrib&architectures=amd64,i386', {}),
+        'katello gzip': ('releases=release0/updates&components=main,contrib&architectures=amd64,i386', {'Accept-Encoding': 'gzip'}),
+        'releases': ('releases=' + some_releases, {}),
+    }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as probe:
+        probe.bind(('::', 0))
+        return probe.getsockname()[1]
+
+
+def memory(pid: int) -> Dict[str, Optional[int]]:
+    result: Dict[str, Optional[int]] = {'rss_bytes': None, 'peak_rss_bytes': None}
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    result['rss_bytes' if key == 'VmRSS' else 'peak_rss_bytes'] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return result
+
+
+def fetch(connection: http.client.HTTPConnection, path: str, headers: Dict[str, str]) -> Tuple[int, int, float]:
+    start = time.monotonic()
+    connection.request('GET', path, headers=headers)
+    response = connection.getresponse()
+    size = len(response.read())
+    return response.status, size, time.monotonic() - start
+
+
+class Server:
+    def __init__(self, datapath: str, args: List[str]) -> None:
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'errata_server', '--port', str(self.port), '--datapath', datapath, '--no-snapshots'] + args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection('localhost', self.port, timeout=300)
+
+    def metrics(self) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+        connection = self.connect()
+        try:
+            connection.request('GET', '/metrics')
+            text = connection.getresponse().read().decode('utf-8')
+        finally:
+            connection.close()
+        result: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        for line in text.splitlines():
+            match = SAMPLE.match(line)
+            if match:
+                name, labels, value = match.groups()
+                result.setdefault(name, []).append((dict(LABEL.findall(labels or '')), float(value)))
+        return result
+
+    def value(self, metrics: Dict, name: str, **labels: str) -> Optional[float]:
+        for sample_labels, value in metrics.get(name, ()):
+            if all(sample_labels.get(key) == label for key, label in labels.items()):
+                return value
+        return None
+
+    # Wait until the server completed the given number of reloads; returns the stage durations
+    def wait_reloaded(self, reloads: int, timeout: float) -> Dict[str, float]:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise click.ClickException("Server exited with status {}".format(self.process.returncode))
+            try:
+                metrics = self.metrics()
+            except OSError:
+                time.sleep(0.05)
+                continue
+            if (self.value(metrics, 'errata_reloads_total', operatingsystem=OPERATINGSYSTEM) or 0) >= reloads:
+                return {
+                    labels['stage']: value
+                    for labels, value in metrics['errata_reload_stage_seconds']
+                    if labels['operatingsystem'] == OPERATINGSYSTEM
+                }
+            time.sleep(0.05)
+        raise click.ClickException("Server did not finish reload {} within {}s".format(reloads, timeout))
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def measure_queries(server: Server, mix: Dict[str, Tuple[str, Dict[str, str]]], repeat: int) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    connection = server.connect()
+    try:
+        for name, (query, headers) in mix.items():
+            path = '/dep/api/v1/{}?{}'.format(OPERATINGSYSTEM, query)
+            status, size, cold = fetch(connection, path, headers)
+            timings = [fetch(connection, path, headers)[2] for _ in range(repeat)]
+            results[name] = {
+                'status': status,
+                'bytes': size,
+                'cold_seconds': cold,
+                'median_seconds': percentile(timings, 0.5),
+                'p95_seconds': percentile(timings, 0.95),
+            }
+    finally:
+        connection.close()
+    return results
+
+
+def measure_throughput(server: Server, mix: Dict[str, Tuple[str, Dict[str, str]]], concurrency: int, requests: int) -> Dict[str, Any]:
+    # the complete list would dominate everything else, so it is left out
+    queries = [('/dep/api/v1/{}?{}'.format(OPERATINGSYSTEM, query), headers) for name, (query, headers) in mix.items() if name != 'all']
+
+    def client(number: int) -> List[Tuple[int, int, float]]:
+        connection = server.connect()
+        try:
+            return [fetch(connection, *queries[request % len(queries)]) for request in range(number, requests, concurrency)]
+        finally:
+            connection.close()
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        responses = [response for result in executor.map(client, range(concurrency)) for response in result]
+    elapsed = time.monotonic() - start
+    latencies = [latency for _, _, latency in responses]
+    return {
+        'concurrency': concurrency,
+        'requests': len(responses),
+        'errors': sum(1 for status, _, _ in responses if status != 200),
+        'seconds': elapsed,
+        'requests_per_second': len(responses) / elapsed,
+        'bytes_per_second': sum(size for _, size, _ in responses) / elapsed,
+        'p50_seconds': percentile(latencies, 0.5),
+        'p95_seconds': percentile(latencies, 0.95),
+    }
+
+
+def run_size(count: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix='errata-bench') as datapath:
+        start = time.monotonic()
+        errata = write_dataset(datapath, OPERATINGSYSTEM, count, options['releases'], options['architectures'], options['seed'])
+        generated = time.monotonic() - start
+        data_bytes = os.path.getsize(os.path.join(datapath, '{}_errata.json'.format(OPERATINGSYSTEM)))
+        click.echo("{} errata: generated {} bytes in {:.1f}s".format(count, data_bytes, generated), err=True)
+
+        start = time.monotonic()
+        server = Server(datapath, ['--reload-processes', str(options['reload_processes']), '--reload-delay', '0.1', '--warm-up', OPERATINGSYSTEM])
+        try:
+            initial_stages = server.wait_reloaded(1, options['timeout'])
+            initial = time.monotonic() - start
+            metrics = server.metrics()
+            loaded_memory = memory(server.process.pid)
+            mix = query_mix(options['releases'])
+            queries = measure_queries(server, mix, options['repeat'])
+            throughput = measure_throughput(server, mix, options['concurrency'], options['requests'])
+
+            # change one percent of the errata, so the reload can be incremental
+            for item in errata[::100]:
+                item['severity'] = 'changed'
+            write_errata(datapath, OPERATINGSYSTEM, errata)
+            start = time.monotonic()
+            incremental_stages = server.wait_reloaded(2, options['timeout'])
+            incremental = time.monotonic() - start
+            final_memory = memory(server.process.pid)
+        finally:
+            server.stop()
+
+    result = {
+        'errata': count,
+        'packages': int(server.value(metrics, 'errata_packages', operatingsystem=OPERATINGSYSTEM) or 0),
+        'data_bytes': data_bytes,
+        'reload': {
+            'initial_seconds': initial,
+            'initial_stages': initial_stages,
+            'incremental_seconds': incremental,
+            'incremental_stages': incremental_stages,
+        },
+        'memory': {
+            'loaded_rss_bytes': loaded_memory['rss_bytes'],
+            'rss_bytes': final_memory['rss_bytes'],
+            'peak_rss_bytes': final_memory['peak_rss_bytes'],
+        },
+        'queries': queries,
+        'throughput': throughput,
+    }
+    click.echo("{} errata: loaded in {:.2f}s, reloaded in {:.2f}s, {:.0f} requests/s".format(
+        count, initial, incremental, throughput['requests_per_second']), err=True)
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(value: Any, prefix: str = '') -> Iterator[Tuple[str, float]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, prefix + '.' + key if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command()
+@click.option('--errata', help='Number of errata; may be given several times', default=(1000, 10000, 100000), multiple=True, type=int)
+@click.option('--releases', help='Number of releases', default=8, type=int)
+@click.option('--architectures', help='Number of architectures besides all', default=6, type=click.IntRange(1, 10))
+@click.option('--seed', help='Seed of the data generator', default=0, type=int)
+@click.option('--repeat', help='Number of timed requests per query', default=20, type=int)
+@click.option('--concurrency', help='Number of concurrent clients', default=16, type=int)
+@click.option('--requests', help='Total number of requests of the concurrent clients', default=2000, type=int)
+@click.option('--reload-processes', help='Passed on to the server', default=2, type=int)
+@click.option('--timeout', help='Seconds to wait for a reload', default=600, type=float)
+@click.option('--output', help='File to write the JSON results to [default: stdout]', default='-', type=click.File('w'))
+def run(output, **options) -> None:
+    """Run the benchmarks and write the results as JSON."""
+    results = [run_size(count, options) for count in options.pop('errata')]
+    simplejson.dump({
+        'format': RESULT_FORMAT,
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': options,
+        'results': results,
+    }, output, indent=2)
+    output.write('\n')
+
+
+@main.command()
+@click.option('--path', help='Directory to write the data files to', required=True, type=click.Path(file_okay=False))
+@click.option('--errata', help='Number of errata', default=10000, type=int)
+@click.option('--releases', help='Number of releases', default=8, type=int)
+@click.option('--architectures', help='Number of architectures besides all', default=6, type=click.IntRange(1, 10))
+@click.option('--seed', help='Seed of the data generator', default=0, type=int)
+def generate(path: str, errata: int, releases: int, architectures: int, seed: int) -> None:
+    """Only write a synthetic dataset, e.g. for profiling."""
+    os.makedirs(path, exist_ok=True)
+    write_dataset(path, OPERATINGSYSTEM, errata, releases, architectures, seed)
+
+
+@main.command()
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def compare(before, after) -> None:
+    """Compare two result files, matching results by number of errata."""
+    old = {result['errata']: dict(flatten(result)) for result in simplejson.load(before)['results']}
+    for result in simplejson.load(after)['results']:
+        previous = old.get(result['errata'])
+        if previous is None:
+            continue
+        click.echo("{} errata".format(result['errata']))
+        for key, value in flatten(result):
+            if key in previous and previous[key]:
+                click.echo("  {:<56} {:>14.6g} {:>14.6g} {:>+8.1%}".format(key, previous[key], value, value / previous[key] - 1))
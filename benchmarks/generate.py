@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import simplejson
+
+from datetime import date, timedelta
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+
+
+COMPONENTS = ('main', 'contrib', 'non-free')
+ARCHITECTURES = ('amd64', 'i386', 'arm64', 'armhf', 'armel', 'ppc64el', 's390x', 'mips64el', 'mipsel', 'riscv64')
+SEVERITIES = ('low', 'medium', 'high', 'not yet assigned')
+WORDS = ('buffer', 'overflow', 'remote', 'attacker', 'crafted', 'input', 'denial', 'service', 'memory', 'leak', 'certificate', 'validation')
+
+
+# Synthetic errata data in the format written by errata_parser
+#
+# All randomness comes from a single seeded generator, so the same
+# parameters always produce byte-identical data files.
+
+def generate_config(releases: int, architectures: int) -> Dict[str, Any]:
+    return {
+        'releases': {
+            'release{}'.format(number): {
+                'aliases': ['release{}/updates'.format(number)],
+                'components': list(COMPONENTS),
+                'architectures': ['all'] + list(ARCHITECTURES[:architectures]),
+            }
+            for number in range(releases)
+        }
+    }
+
+
+def generate_errata(count: int, config: Dict[str, Any], seed: int = 0, packages: int = 4) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    releases = list(config['releases'].items())
+    first_issued = date(2000, 1, 1)
+    errata = []
+    for number in range(count):
+        source = 'source{}'.format(rng.randrange(count // 4 + 1))
+        binaries = ['{}{}'.format(source, suffix) for suffix in ('', '-common', '-dev', '-doc', '-utils')[:rng.randint(1, packages)]]
+        affected = rng.sample(releases, rng.randint(1, min(3, len(releases))))
+        erratum_packages = []
+        for release, release_config in affected:
+            component = rng.choice(release_config['components'])
+            architectures = rng.sample(release_config['architectures'], rng.randint(1, len(release_config['architectures'])))
+            version = '{}.{}-{}+deb{}u1'.format(rng.randint(0, 9), rng.randint(0, 99), rng.randint(1, 9), rng.randint(1, 99))
+            for binary in binaries:
+                for architecture in architectures:
+                    erratum_packages.append({
+                        'name': binary,
+                        'version': version,
+                        'architecture': architecture,
+                        'component': component,
+                        'release': release,
+                    })
+        issued = first_issued + timedelta(days=number * 3650 // max(count, 1))
+        errata.append({
+            'name': 'DSA-{}-1'.format(1000 + number),
+            'title': '{} -- security update'.format(source),
+            'issued': issued.strftime('%d %b %Y'),
+            'affected_source_package': source,
+            'packages': erratum_packages,
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))),
+            'cves': ['CVE-{}-{}'.format(issued.year, rng.randint(1000, 99999)) for _ in range(rng.randint(1, 4))],
+            'severity': rng.choice(SEVERITIES),
+            'scope': rng.choice(('local', 'remote')),
+        })
+    return errata
+
+
+# Write <operatingsystem>_config.json and <operatingsystem>_errata.json to path
+# The errata file is written first, so a new config never comes with old errata.
+def write_dataset(
+    path: str,
+    operatingsystem: str,
+    count: int,
+    releases: int = 8,
+    architectures: int = 6,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    config = generate_config(releases, architectures)
+    errata = generate_errata(count, config, seed)
+    write_errata(path, operatingsystem, errata)
+    with open(os.path.join(path, '{}_config.json'.format(operatingsystem)), 'w') as config_file:
+        simplejson.dump(config, config_file)
+    return errata
+
+
+def write_errata(path: str, operatingsystem: str, errata: List[Dict[str, Any]]) -> None:
+    with open(os.path.join(path, '{}_errata.json'.format(operatingsystem)), 'w') as errata_file:
+        simplejson.dump(errata, errata_file)
@@ -0,0 +1,3 @@
+from errata_server import main
+
+main()
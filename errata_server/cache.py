@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Optional,
+    Tuple,
+)
+
+
+# Bounded LRU cache of serialized response bodies
+#
+# Entries are evicted least recently used first as soon as either the number
+# of entries or their total size in bytes exceeds the configured limit.
+# Bodies larger than max_bytes are never cached.
+class ResponseCache:
+    def __init__(self, max_entries: int = 64, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, key: Hashable, body: bytes) -> None:
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = body
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    # drop all entries whose key matches the predicate
+    def discard(self, predicate: Callable[[Hashable], bool]) -> int:
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            self.size -= len(self.entries.pop(key))
+        return len(keys)
+
+    def __str__(self) -> str:
+        return "{} entries, {} bytes, {} hits, {} misses".format(len(self.entries), self.size, self.hits, self.misses)
+
+
+class Flight:
+    __slots__ = ('future', 'users')
+
+    def __init__(self, future: asyncio.Future) -> None:
+        self.future = future
+        self.users = 0
+
+
+# Shares the result of one computation between concurrent callers
+#
+# The first caller joining a key starts the computation; everybody joining
+# the same key until the last caller is done with the result gets the same
+# result (or exception). Waiting callers do not cancel the computation.
+class SingleFlight:
+    def __init__(self) -> None:
+        self.flights: Dict[Hashable, Flight] = {}
+
+    # start is called right away by the first caller, and must return an awaitable of the result
+    # Yields the result and whether it was started by another caller.
+    @asynccontextmanager
+    async def join(self, key: Hashable, start: Callable[[], Awaitable]) -> AsyncIterator[Tuple[Any, bool]]:
+        flight = self.flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(start()))
+        flight.users += 1
+        try:
+            yield await asyncio.shield(flight.future), shared
+        finally:
+            flight.users -= 1
+            if not flight.users and self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def __len__(self) -> int:
+        return len(self.flights)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import threading
+
+from typing import (
+    Callable,
+    Dict,
+    Optional,
+)
+
+# brotli and zstd are only offered if the respective optional package is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def gzip_compress(data: bytes) -> bytes:
+    # wbits 31 writes a gzip header with a zero mtime, so equal data compresses to equal bytes
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+_local = threading.local()
+
+
+# Responses are compressed on executor threads, and a ZstdCompressor must not be used by several threads at once
+def zstd_compress(data: bytes) -> bytes:
+    compressor = getattr(_local, 'zstd', None)
+    if compressor is None:
+        compressor = _local.zstd = zstandard.ZstdCompressor(level=9)
+    return compressor.compress(data)
+
+
+# Supported content codings in order of preference
+ENCODERS: Dict[bytes, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    ENCODERS[b'zstd'] = zstd_compress
+if brotli is not None:
+    ENCODERS[b'br'] = lambda data: brotli.compress(data, quality=6)
+ENCODERS[b'gzip'] = gzip_compress
+
+
+# Pick the preferred content coding acceptable according to the Accept-Encoding header
+# Returns None for the identity coding.
+def negotiate(accept_encoding: Optional[bytes]) -> Optional[bytes]:
+    if not accept_encoding:
+        return None
+    qualities: Dict[bytes, float] = {}
+    for entry in accept_encoding.lower().split(b','):
+        coding, _, parameters = entry.partition(b';')
+        quality = 1.0
+        for parameter in parameters.split(b';'):
+            name, _, value = parameter.partition(b'=')
+            if name.strip() == b'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip()] = quality
+    wildcard = qualities.get(b'*', 0.0)
+    best = None
+    best_quality = 0.0
+    for coding in ENCODERS:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(data: bytes, encoding: bytes) -> bytes:
+    return ENCODERS[encoding](data)
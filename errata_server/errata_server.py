@@ -1,48 +1,180 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import socket
 import click
 
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+)
+
 from twisted.internet import asyncioreactor
 asyncioreactor.install()
 
 from twisted.web import server
-from twisted.web.resource import NoResource
+from twisted.web.resource import NoResource, Resource
+from twisted.web.http import Request
 from twisted.internet import reactor, endpoints
 from twisted.python import log
 
 from errata_server import api_beta
 from errata_server import api_v1
+from errata_server.loader import discover_operatingsystems, load_data
+from errata_server.metrics import Metrics, MetricsResource
+from errata_server.registry import DataStores
+from errata_server.snapshot import snapshot_filename, write_snapshot
+from errata_server.workers import WorkerPool
 
 
-@click.command()
-@click.option('--port', help='Port number to serve on', default=8015, type=int)
-@click.option('--datapath', help='Path where the data files are located', default='/srv/errata', type=str)
-@click.option('--beta/--no-beta', help='Serve beta api', default=False)
-def main(port: int, datapath: str, beta: bool) -> None:
-    # build document tree
+# The endpoints of one api version, one for every operating system with data
+# Endpoints are created on the first request, which also loads the data.
+class ApiVersion(NoResource):
+    def __init__(self, module, version: str, stores: DataStores, metrics: Metrics, options: Dict) -> None:
+        super(ApiVersion, self).__init__()
+        self.module = module
+        self.version = version
+        self.stores = stores
+        self.metrics = metrics
+        self.options = options
+        self.endpoints: Dict[bytes, Resource] = {}
+
+    def getChild(self, path: bytes, request: Request) -> Resource:
+        endpoint = self.endpoints.get(path)
+        if endpoint is None:
+            operatingsystem = path.decode('utf-8', 'replace')
+            store = self.stores.get(operatingsystem)
+            if store is None:
+                return NoResource()
+            endpoint = self.endpoints[path] = self.module.Endpoint(store, metrics=self.metrics.endpoint(self.version, operatingsystem), **self.options)
+        return endpoint
+
+
+def build_tree(stores: DataStores, beta: bool, options: Dict, metrics: Optional[Metrics] = None) -> Resource:
+    metrics = metrics if metrics is not None else Metrics()
     root = NoResource()
+    root.putChild(b'metrics', MetricsResource(metrics, stores.stores))  # served at /metrics
+
     dep = NoResource()
     root.putChild(b'dep', dep)
     api = NoResource()
     dep.putChild(b'api', api)
-    # --- beta api ---
-    if beta:
-        apibeta = NoResource()
-        api.putChild(b'beta', apibeta)
-        apibeta.putChild(b'debian', api_beta.Endpoint('debian', datapath))  # served at /api/beta/debian
-        apibeta.putChild(b'ubuntu', api_beta.Endpoint('ubuntu', datapath))  # served at /api/beta/ubuntu
-        apibeta.putChild(b'ubuntu-esm', api_beta.Endpoint('ubuntu-esm', datapath))  # served at /api/beta/ubuntu-esm
-    # --- api v1 ---
-    apiv1 = NoResource()
-    api.putChild(b'v1', apiv1)
-    apiv1.putChild(b'debian', api_v1.Endpoint('debian', datapath))  # served at /api/v1/debian
-    apiv1.putChild(b'ubuntu', api_v1.Endpoint('ubuntu', datapath))  # served at /api/v1/ubuntu
-    apiv1.putChild(b'ubuntu-esm', api_v1.Endpoint('ubuntu-esm', datapath))  # served at /api/v1/ubuntu-esm
+    versions = [(b'beta', api_beta)] if beta else []
+    for version, module in versions + [(b'v1', api_v1)]:
+        # served at /dep/api/<version>/<operatingsystem>
+        api.putChild(version, ApiVersion(module, version.decode('utf-8'), stores, metrics, options))
+    return root
+
+
+@click.command()
+@click.option('--port', help='Port number to serve on', default=8015, type=int)
+@click.option('--datapath', help='Path where the data files are located', default='/srv/errata', type=str)
+@click.option('--beta/--no-beta', help='Serve beta api', default=False)
+@click.option('--cache-size', help='Number of filtered responses cached per endpoint', default=64, type=int)
+@click.option('--cache-bytes', help='Total size in bytes of filtered responses cached per endpoint', default=64 * 1024 * 1024, type=int)
+@click.option('--stream-threshold', help='Stream responses with more errata than this instead of caching them', default=1000, type=int)
+@click.option('--batch-limit', help='Maximum number of filter sets in a batch request', default=256, type=int)
+@click.option('--history-size', help='Number of data versions accepted by the since parameter', default=16, type=int)
+@click.option('--verify-data', help='Reload only when the content of the data files changed, not just their size or mtime', is_flag=True)
+@click.option('--reload-delay', help='Seconds without changes to the data files before reloading them', default=1.0, type=float)
+@click.option('--reload-processes', help='Number of processes parsing data files; 0 uses threads', default=2, type=int)
+@click.option('--snapshots/--no-snapshots', help='Load and store binary snapshots of the data', default=True)
+@click.option('--snapshot-path', help='Path where snapshots are stored [default: datapath]', default=None, type=str)
+@click.option('--build-snapshots', help='Build snapshots for all operating systems and exit', is_flag=True)
+@click.option('--warm-up', help='Load the data of this operating system at startup instead of on the first request', multiple=True, type=str)
+@click.option('--idle-timeout', help='Drop the data of operating systems not requested for this many seconds; 0 keeps it', default=0, type=float)
+@click.option('--workers', help='Number of serving processes sharing the port and the snapshots', default=1, type=int)
+@click.option('--worker-fd', help='Serve on this inherited socket as a worker', default=None, type=int, hidden=True)
+@click.option('--worker-number', help='Number of this worker, exported as label of its metrics', default=None, type=int, hidden=True)
+def main(
+    port: int,
+    datapath: str,
+    beta: bool,
+    cache_size: int,
+    cache_bytes: int,
+    stream_threshold: int,
+    batch_limit: int,
+    history_size: int,
+    verify_data: bool,
+    reload_delay: float,
+    reload_processes: int,
+    snapshots: bool,
+    snapshot_path: Optional[str],
+    build_snapshots: bool,
+    warm_up: Tuple[str, ...],
+    idle_timeout: float,
+    workers: int,
+    worker_fd: Optional[int],
+    worker_number: Optional[int],
+) -> None:
+    if snapshot_path is None:
+        snapshot_path = datapath
+    if build_snapshots:
+        for operatingsystem in discover_operatingsystems(datapath):
+            filename = snapshot_filename(snapshot_path, operatingsystem)
+            click.echo("Building snapshot {}".format(filename))
+            write_snapshot(filename, load_data(datapath, operatingsystem))
+        return
+    if (workers > 1 or worker_fd is not None) and not snapshots:
+        raise click.UsageError("Serving with several workers needs snapshots")
+    # the workers only serve the snapshots written by the parent
+    if workers > 1 and not (os.path.isdir(snapshot_path) and os.access(snapshot_path, os.W_OK)):
+        raise click.UsageError("Serving with several workers needs a writable snapshot path, {} is not".format(snapshot_path))
 
     # run server
     log.startLogging(sys.stdout)
-    endpoints.serverFromString(reactor, r"tcp:interface=\:\::port={}".format(port)).listen(server.Site(root))
+
+    # e.g. a read-only data location still serves prebuilt snapshots
+    write_snapshots = snapshots and worker_fd is None
+    if write_snapshots and not os.access(snapshot_path, os.W_OK):
+        log.msg("Snapshot path {} is not writable; snapshots are only read".format(snapshot_path))
+        write_snapshots = False
+
+    # one data store per operating system, shared by all api versions
+    # workers only follow the snapshots their parent writes, so the parent loads all data right away
+    executor = ProcessPoolExecutor(reload_processes) if reload_processes > 0 and worker_fd is None else None
+    stores = DataStores(
+        datapath,
+        dict(
+            cache_size=cache_size,
+            cache_bytes=cache_bytes,
+            executor=executor,
+            snapshot_path=snapshot_path if snapshots else None,
+            write_snapshots=write_snapshots,
+            follow=worker_fd is not None,
+            history_size=history_size,
+            verify=verify_data,
+            reload_delay=reload_delay,
+        ),
+        warm_up=warm_up,
+        eager=workers > 1,
+        idle_timeout=idle_timeout if workers == 1 else None,
+    )
+    # any worker may answer a scrape, so the metrics of every worker form series of their own
+    metrics = Metrics((('worker', str(worker_number)),) if worker_number is not None else ())
+    site = server.Site(build_tree(stores, beta, {'stream_threshold': stream_threshold, 'batch_limit': batch_limit}, metrics))
+    if worker_fd is not None:
+        reactor.adoptStreamPort(worker_fd, socket.AF_INET6, site)
+    elif workers > 1:
+        listening = reactor.listenTCP(port, site, interface='::')
+        listening.stopReading()
+        WorkerPool(workers, listening.fileno(), [
+            '--datapath', datapath,
+            '--beta' if beta else '--no-beta',
+            '--cache-size', str(cache_size),
+            '--cache-bytes', str(cache_bytes),
+            '--stream-threshold', str(stream_threshold),
+            '--batch-limit', str(batch_limit),
+            '--history-size', str(history_size),
+            '--reload-delay', str(reload_delay),
+            '--idle-timeout', str(idle_timeout),
+            '--snapshot-path', snapshot_path,
+        ] + [argument for operatingsystem in warm_up for argument in ('--warm-up', operatingsystem)]).start()
+    else:
+        endpoints.serverFromString(reactor, r"tcp:interface=\:\::port={}".format(port)).listen(site)
     reactor.run()
 
 
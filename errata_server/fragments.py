@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import simplejson
+
+from array import array
+from datetime import datetime, timezone
+
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+
+DIGEST_SIZE = 16
+DATE_FORMATS = ('%d %b %Y', '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
+
+
+def _dumps(value) -> bytes:
+    return simplejson.dumps(value).encode('utf-8')
+
+
+def _digest(body: bytes) -> bytes:
+    return hashlib.blake2b(body, digest_size=DIGEST_SIZE).digest()
+
+
+# Day of an issued date as proleptic Gregorian ordinal; 0 if it is missing or cannot be parsed
+# Dates are given like '01 Jan 2019' or '2019-01-01', or as seconds since the epoch.
+def parse_date(value: Any) -> int:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return datetime.fromtimestamp(value, timezone.utc).toordinal()
+        except (OverflowError, OSError, ValueError):
+            return 0
+    if not isinstance(value, str):
+        return 0
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value[:19], date_format).toordinal()
+        except ValueError:
+            continue
+    return 0
+
+
+# An erratum kept as its encoded JSON body
+#
+# offsets holds the start of every package's JSON within body, followed by
+# the end of the last package plus two; as packages are separated by ', ',
+# package i spans offsets[i] to offsets[i + 1] - 2. A body restricted to
+# some of the packages is assembled from slices of body without encoding
+# anything again, adjacent packages as a single slice. The body is byte-identical to
+# simplejson.dumps(item). digest identifies the body when comparing data
+# generations. issued is the parsed issued date (see parse_date), and
+# generation the data generation of the store that last changed the erratum.
+class SerializedErratum:
+    __slots__ = ('name', 'body', 'offsets', 'digest', 'issued', 'generation')
+
+    def __init__(self, item: Dict) -> None:
+        self.name = item.get('name')
+        self.issued = parse_date(item.get('issued'))
+        self.generation = 0
+        self.offsets = array('I')
+        parts: List[bytes] = []
+        size = 1
+        for key, value in item.items():
+            if parts:
+                parts.append(b', ')
+                size += 2
+            if key == 'packages':
+                part = _dumps(key) + b': ['
+                parts.append(part)
+                size += len(part)
+                for position, package in enumerate(value):
+                    if position:
+                        parts.append(b', ')
+                        size += 2
+                    part = _dumps(package)
+                    self.offsets.append(size)
+                    parts.append(part)
+                    size += len(part)
+                self.offsets.append(size + 2)
+                parts.append(b']')
+                size += 1
+            else:
+                part = _dumps(key) + b': ' + _dumps(value)
+                parts.append(part)
+                size += len(part)
+        self.body = b'{' + b''.join(parts) + b'}'
+        self.digest = _digest(self.body)
+
+    # Recreate an erratum from its stored parts; body may be any bytes-like object
+    @classmethod
+    def restore(cls, name: Optional[str], body: Any, offsets: array, digest: bytes, issued: int = 0) -> 'SerializedErratum':
+        item = cls.__new__(cls)
+        item.name, item.body, item.offsets, item.digest = name, body, offsets, digest
+        item.issued, item.generation = issued, 0
+        return item
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1 if self.offsets else 0
+
+    # Render the erratum with only the packages at the given (ascending) positions
+    def render(self, positions: Optional[List[int]] = None) -> bytes:
+        if positions is None or len(positions) == len(self):
+            return self.body
+        body, offsets = self.body, self.offsets
+        slices = []
+        first = last = positions[0]
+        for position in positions[1:]:
+            if position != last + 1:
+                slices.append(body[offsets[first]:offsets[last + 1] - 2])
+                first = position
+            last = position
+        slices.append(body[offsets[first]:offsets[last + 1] - 2])
+        return b''.join((body[:offsets[0]], b', '.join(slices), body[offsets[-1] - 2:]))
+
+
+# Join rendered errata to a JSON list; identical to simplejson.dumps of the list of errata
+def join_fragments(fragments: Iterable[bytes]) -> bytes:
+    return b'[' + b', '.join(fragments) + b']'
+
+
+def package_targets(packages: List[Dict]) -> Set[Tuple[str, str, str]]:
+    return set((package['release'], package['component'], package['architecture']) for package in packages)
+
+
+# Summary of the changes between two errata lists
+#
+# targets collects the (release, component, architecture) triples of all
+# packages of added, changed and removed errata; responses to filters not
+# matching any of them are unaffected by the change. The previous versions
+# of changed and removed errata are only known by name until they are added
+# with add_previous. If incremental is False, the order of errata changed,
+# and every response must be considered affected.
+class ErrataDiff:
+    def __init__(self) -> None:
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.targets: Set[Tuple[str, str, str]] = set()
+        self.previous: List[str] = []
+        self.incremental = True
+
+    def add_previous(self, item: SerializedErratum) -> None:
+        self.targets.update(package_targets(simplejson.loads(bytes(item.body))['packages']))
+
+    # Filters by key only narrow down the errata, so they are not considered
+    def affects(self, filters: Tuple[Optional[FrozenSet], ...]) -> bool:
+        if not self.incremental:
+            return True
+        releases, components, architectures = filters[:3]
+        return any(
+            (releases is None or release in releases)
+            and (components is None or component in components)
+            and (architectures is None or architecture in architectures)
+            for release, component, architecture in self.targets
+        )
+
+    def __str__(self) -> str:
+        return "{} added, {} changed, {} removed, {} unchanged".format(self.added, self.changed, self.removed, self.unchanged)
+
+
+# Placeholder for an unchanged erratum, holding its position in the previous errata
+class Retained(NamedTuple):
+    position: int
+
+
+# Serializes errata one at a time, as they are parsed
+#
+# Without digests every erratum is serialized. Otherwise digests maps the
+# unique names of the previous errata to their digests in their original
+# order, and errata whose digest is unchanged are replaced by Retained; the
+# changes are summarized in diff. Only errata with a str name can be retained.
+class ErrataSerializer:
+    def __init__(self, digests: Optional[Dict[str, bytes]]) -> None:
+        self.digests = digests
+        self.positions = {name: position for position, name in enumerate(digests)} if digests is not None else None
+        self.diff = ErrataDiff() if digests is not None else None
+        self.result: List[Union[SerializedErratum, Retained]] = []
+        self.retained: List[int] = []
+
+    def add(self, item: Dict) -> None:
+        if self.diff is None:
+            self.result.append(SerializedErratum(item))
+            return
+        name = item.get('name')
+        position = self.positions.pop(name, None) if isinstance(name, str) else None
+        body = _dumps(item)
+        if position is not None and self.digests[name] == _digest(body):
+            self.result.append(Retained(position))
+            self.retained.append(position)
+            self.diff.unchanged += 1
+            return
+        self.result.append(SerializedErratum(item))
+        self.diff.targets.update(package_targets(item['packages']))
+        if position is None:
+            self.diff.added += 1
+        else:
+            self.diff.changed += 1
+            self.diff.previous.append(name)
+
+    def finish(self) -> Tuple[List[Union[SerializedErratum, Retained]], Optional[ErrataDiff]]:
+        if self.diff is not None:
+            self.diff.removed = len(self.positions)
+            self.diff.previous.extend(self.positions)
+            if self.retained != sorted(self.retained):
+                self.diff.incremental = False
+        return self.result, self.diff
+
+
+def diff_errata(digests: Dict[str, bytes], new_data: Iterable[Dict]) -> Tuple[List[Union[SerializedErratum, Retained]], ErrataDiff]:
+    serializer = ErrataSerializer(digests)
+    for item in new_data:
+        serializer.add(item)
+    return serializer.finish()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+from array import array
+from bisect import bisect_right
+
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from errata_server.fragments import SerializedErratum
+
+# filters are evaluated as masks over whole columns if numpy is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the keys errata are looked up by, in the order of ErrataIndex.keys
+KEY_NAMES = ('packages', 'source_packages', 'cves')
+
+
+# Most keys belong to a single erratum, whose position is stored as a plain int instead of an array
+def key_positions(entry: Union[None, int, array]) -> Iterable[int]:
+    if entry is None:
+        return ()
+    return (entry,) if isinstance(entry, int) else entry
+
+
+# Columnar table of all packages of an errata list
+#
+# Every package gets a global id in errata order; the packages of erratum i
+# are numbered offsets[i] to offsets[i + 1] - 1. For each of release,
+# component and architecture, values maps every value to a small integer
+# code, and the column holds the code of every package.
+#
+# With numpy, a lookup turns the wanted values of each dimension into a
+# table of allowed codes and evaluates it on the whole column at once.
+# Without it, posting lists of the package ids carrying each code are
+# derived from the columns on first use.
+#
+# keys holds a hash index for each of the binary package names, the
+# affected source package and the CVE ids, mapping every key to the
+# ascending positions of the errata carrying it (see key_positions). Lookups
+# by key only visit the errata found there, so they take time proportional
+# to the result.
+class ErrataIndex:
+    def __init__(self, data: Iterable[Dict] = ()) -> None:
+        self.offsets = array('I', [0])
+        self.values: Tuple[Dict[str, int], ...] = ({}, {}, {})
+        self.columns: Tuple[array, ...] = (array('H'), array('H'), array('H'))
+        self.keys: Tuple[Dict[str, Union[int, array]], ...] = ({}, {}, {})
+        self._postings: Optional[List[Dict[int, array]]] = None
+        self._vectors = None
+        self._targets = None
+        for item in data:
+            self.add(item)
+
+    # Append the packages of the next erratum
+    def add(self, item: Dict) -> None:
+        packages = item['packages']
+        releases, components, architectures = self.values
+        release_column, component_column, architecture_column = self.columns
+        for package in packages:
+            release_column.append(releases.setdefault(package['release'], len(releases)))
+            component_column.append(components.setdefault(package['component'], len(components)))
+            architecture_column.append(architectures.setdefault(package['architecture'], len(architectures)))
+        position = len(self.offsets) - 1
+        self.offsets.append(self.offsets[-1] + len(packages))
+        source = item.get('affected_source_package')
+        item_keys = (
+            set(package.get('name') for package in packages),
+            {source},
+            set(item.get('cves') or ()),
+        )
+        for keys, values in zip(self.keys, item_keys):
+            for value in values:
+                if not isinstance(value, str):
+                    continue
+                known = keys.get(value)
+                if known is None:
+                    keys[value] = position
+                elif isinstance(known, int):
+                    keys[value] = array('I', (known, position))
+                else:
+                    known.append(position)
+
+    # Recreate an index from its stored arrays, or memoryviews cast to the same type; values lists the values of every dimension in code order
+    @classmethod
+    def restore(
+        cls,
+        offsets: array,
+        values: List[List[str]],
+        columns: List[array],
+        keys: List[Dict[str, Union[int, array]]],
+    ) -> 'ErrataIndex':
+        index = cls.__new__(cls)
+        index.offsets, index.columns, index.keys = offsets, tuple(columns), tuple(keys)
+        index.values = tuple({value: code for code, value in enumerate(dimension)} for dimension in values)
+        index._postings = index._vectors = index._targets = None
+        return index
+
+    # The cached lookup structures are rebuilt where they are needed
+    def __getstate__(self) -> Dict:
+        return dict(self.__dict__, _postings=None, _vectors=None, _targets=None)
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def memory_usage(self) -> int:
+        size = sys.getsizeof(self.offsets) + sum(sys.getsizeof(column) for column in self.columns)
+        for values in self.values:
+            size += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+        for keys in self.keys:
+            size += sys.getsizeof(keys) + sum(sys.getsizeof(key) + sys.getsizeof(positions) for key, positions in keys.items())
+        if self._postings is not None:
+            for postings in self._postings:
+                size += sys.getsizeof(postings) + sum(sys.getsizeof(package_ids) for package_ids in postings.values())
+        return size
+
+    # The wanted codes of every filtered dimension
+    def _codes(self, wanted_values: Tuple[Optional[Set[str]], ...]) -> List[Tuple[int, List[int]]]:
+        return [
+            (dimension, [self.values[dimension][value] for value in wanted if value in self.values[dimension]])
+            for dimension, wanted in enumerate(wanted_values)
+            if wanted is not None
+        ]
+
+    # Returns (erratum position, package positions) pairs in errata order, or
+    # None if no filter is given at all and every erratum matches unchanged.
+    # Errata are selected by any of the given values of each key, and only
+    # render the packages matching release, component and architecture.
+    def lookup(
+        self,
+        releases: Optional[Set[str]],
+        components: Optional[Set[str]],
+        architectures: Optional[Set[str]],
+        packages: Optional[Set[str]] = None,
+        source_packages: Optional[Set[str]] = None,
+        cves: Optional[Set[str]] = None,
+    ) -> Optional[Iterator[Tuple[int, List[int]]]]:
+        filters = self._codes((releases, components, architectures))
+        errata = self._lookup_keys((packages, source_packages, cves))
+        if errata is not None:
+            return self._select(errata, filters)
+        if not filters:
+            return None
+        if not len(self):
+            return iter(())
+        if numpy is not None:
+            return self._lookup_vectorized(filters)
+        if self._postings is None:
+            self._postings = [self._build_postings(column) for column in self.columns]
+        package_ids = set.intersection(*sorted((self._union(self._postings[dimension], codes) for dimension, codes in filters), key=len))
+        return self._group(sorted(package_ids))
+
+    # Positions of the errata carrying any of the wanted values of every key, or None if no key is wanted
+    def _lookup_keys(self, wanted_keys: Tuple[Optional[Set[str]], ...]) -> Optional[List[int]]:
+        errata: Optional[Set[int]] = None
+        for keys, wanted in zip(self.keys, wanted_keys):
+            if wanted is None:
+                continue
+            matches: Set[int] = set()
+            for value in wanted:
+                matches.update(key_positions(keys.get(value)))
+            errata = matches if errata is None else errata & matches
+        return None if errata is None else sorted(errata)
+
+    # Check the packages of the given errata only
+    def _select(self, errata: List[int], filters: List[Tuple[int, List[int]]]) -> Iterator[Tuple[int, List[int]]]:
+        checks = [(self.columns[dimension], set(codes)) for dimension, codes in filters]
+        for erratum in errata:
+            start = self.offsets[erratum]
+            positions = [
+                package_id - start
+                for package_id in range(start, self.offsets[erratum + 1])
+                if all(column[package_id] in codes for column, codes in checks)
+            ]
+            if positions:
+                yield erratum, positions
+
+    @staticmethod
+    def _build_postings(column: array) -> Dict[int, array]:
+        postings: Dict[int, array] = {}
+        for package_id, code in enumerate(column):
+            postings.setdefault(code, array('I')).append(package_id)
+        return postings
+
+    @staticmethod
+    def _union(postings: Dict[int, array], codes: List[int]) -> Set[int]:
+        result: Set[int] = set()
+        for code in codes:
+            result.update(postings.get(code, ()))
+        return result
+
+    def _group(self, package_ids: List[int]) -> Iterator[Tuple[int, List[int]]]:
+        erratum = -1
+        positions: List[int] = []
+        for package_id in package_ids:
+            if package_id >= self.offsets[erratum + 1]:
+                if positions:
+                    yield erratum, positions
+                erratum = bisect_right(self.offsets, package_id) - 1
+                positions = []
+            positions.append(package_id - self.offsets[erratum])
+        if positions:
+            yield erratum, positions
+
+    # Look up several (releases, components, architectures) filters at once; returns the result of lookup for each
+    # With numpy, every package is reduced to the code of its combination of
+    # release, component and architecture once. The allowed combinations of
+    # all filters are then evaluated together on the few distinct ones, and
+    # each filter only takes a single pass over the packages.
+    # Filters by key are looked up on their own, as they only visit the errata found by key.
+    def lookup_many(self, filter_sets: List[Tuple[Optional[Set[str]], ...]]) -> List[Optional[Iterator[Tuple[int, List[int]]]]]:
+        if numpy is None or not len(self):
+            return [self.lookup(*filters) for filters in filter_sets]
+        self._prepare_vectors()
+        if self._targets is None:
+            combined = numpy.zeros(len(self), dtype=numpy.int64)
+            for column in self._vectors[2]:
+                combined = (combined << 16) | column
+            combinations, targets = numpy.unique(combined, return_inverse=True)
+            # the codes of the release, component and architecture of every combination
+            self._targets = (targets.reshape(-1).astype(numpy.int32), [(combinations >> shift) & 0xFFFF for shift in (32, 16, 0)])
+        targets, dimensions = self._targets
+        results: List[Optional[Iterator[Tuple[int, List[int]]]]] = []
+        for filters in filter_sets:
+            if any(wanted is not None for wanted in filters[3:]):
+                results.append(self.lookup(*filters))
+                continue
+            codes = self._codes(filters[:3])
+            if not codes:
+                results.append(None)
+                continue
+            allowed = numpy.ones(len(dimensions[0]), dtype=bool)
+            for dimension, wanted in codes:
+                allowed &= numpy.isin(dimensions[dimension], wanted)
+            results.append(self._group_mask(allowed[targets]))
+        return results
+
+    def _prepare_vectors(self) -> None:
+        if self._vectors is None:
+            offsets = numpy.asarray(self.offsets).astype(numpy.int64)
+            # the erratum of every package, so matches need not be searched in offsets
+            package_errata = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+            self._vectors = (offsets, package_errata, [numpy.asarray(column) for column in self.columns])
+
+    def _lookup_vectorized(self, filters: List[Tuple[int, List[int]]]) -> Iterator[Tuple[int, List[int]]]:
+        self._prepare_vectors()
+        columns = self._vectors[2]
+        mask = None
+        for dimension, codes in filters:
+            allowed = numpy.zeros(len(self.values[dimension]), dtype=bool)
+            allowed[codes] = True
+            matches = allowed[columns[dimension]]
+            if mask is None:
+                mask = matches
+            else:
+                mask &= matches
+        return self._group_mask(mask)
+
+    # Group the packages selected by mask by erratum
+    def _group_mask(self, mask) -> Iterator[Tuple[int, List[int]]]:
+        offsets, package_errata, _ = self._vectors
+        package_ids = numpy.flatnonzero(mask)
+        if not len(package_ids):
+            return iter(())
+        errata = package_errata[package_ids]
+        positions = (package_ids - offsets[errata]).tolist()
+        # the matches of every erratum are a contiguous run of package_ids
+        bounds = [0] + (numpy.flatnonzero(numpy.diff(errata)) + 1).tolist() + [len(positions)]
+        return (
+            (erratum, positions[start:end])
+            for erratum, start, end in zip(errata[bounds[:-1]].tolist(), bounds, bounds[1:])
+        )
+
+
+# Render the errata matching the filter to their JSON fragments
+# filters holds the wanted releases, components and architectures, optionally followed by the wanted keys.
+def filter_fragments(
+    data: List[SerializedErratum],
+    index: ErrataIndex,
+    filters: Tuple[Optional[Set[str]], ...],
+    predicate: Optional[Callable[[SerializedErratum], bool]] = None,
+) -> List[bytes]:
+    matches = index.lookup(*filters)
+    if matches is None:
+        # errata without any packages are never delivered
+        return [item.body for item in data if len(item) and (predicate is None or predicate(item))]
+    return [data[erratum].render(positions) for erratum, positions in matches if predicate is None or predicate(data[erratum])]
+
+
+# Render the errata matching any of the filters, every distinct rendering once
+# Returns the fragments and, for every filter, the positions of its matching
+# errata within the fragments. Errata with the same packages selected by
+# several filters share their fragment.
+def filter_batch(
+    data: List[SerializedErratum],
+    index: ErrataIndex,
+    filter_sets: List[Tuple[Optional[Set[str]], ...]],
+) -> Tuple[List[bytes], List[List[int]]]:
+    fragments: List[bytes] = []
+    rendered: Dict[Tuple[int, Optional[Tuple[int, ...]]], int] = {}
+    results: Dict[Tuple[Optional[Set[str]], ...], List[int]] = {}
+    # identical filters are only looked up once
+    unique = list(dict.fromkeys(filter_sets))
+    for filters, matches in zip(unique, index.lookup_many(unique)):
+        if matches is None:
+            # errata without any packages are never delivered
+            matches = ((erratum, None) for erratum, item in enumerate(data) if len(item))
+        result = []
+        for erratum, positions in matches:
+            key = (erratum, tuple(positions) if positions is not None and len(positions) != len(data[erratum]) else None)
+            number = rendered.get(key)
+            if number is None:
+                number = rendered[key] = len(fragments)
+                fragments.append(data[erratum].render(positions))
+            result.append(number)
+        results[filters] = result
+    return fragments, [results[filters] for filters in filter_sets]
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import codecs
+import hashlib
+import simplejson
+
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from errata_server.fragments import ErrataDiff, ErrataSerializer, Retained, SerializedErratum
+from errata_server.index import ErrataIndex
+
+
+# Everything in this module runs in a worker of a concurrent.futures executor,
+# so the event loop keeps serving requests while new data is parsed. The
+# functions are synchronous and their results must be picklable.
+
+
+def read_json(filename: str, hasher: Any = None) -> Any:
+    with open(filename, 'rb') as fd:
+        raw = fd.read()
+    if hasher is not None:
+        hasher.update(raw)
+    return simplejson.loads(raw)
+
+
+WHITESPACE = ' \t\n\r'
+
+
+# Parse a file containing a JSON list, yielding one item at a time
+#
+# Only chunk_size bytes of the file and the item being decoded are held in
+# memory. Items are decoded with raw_decode from a buffer that is refilled
+# whenever an item does not fit; an item ending right at the end of the
+# buffer is decoded again with more data, so numbers are never cut off.
+def iter_json_list(filename: str, hasher: Any = None, chunk_size: int = 1024 * 1024) -> Iterator[Any]:
+    decoder = simplejson.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    with open(filename, 'rb') as fd:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def fill() -> bool:
+            nonlocal buffer, position, eof
+            if eof:
+                return False
+            raw = fd.read(chunk_size)
+            if hasher is not None:
+                hasher.update(raw)
+            eof = not raw
+            buffer = buffer[position:] + utf8.decode(raw, final=eof)
+            position = 0
+            return True
+
+        # returns the next character that is not whitespace, or '' at the end of the file
+        def skip_whitespace() -> str:
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in WHITESPACE:
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                if not fill():
+                    return ''
+
+        assert skip_whitespace() == '[', "Errata list should be a list"
+        position += 1
+        if skip_whitespace() == ']':
+            position += 1
+        else:
+            while True:
+                while True:
+                    try:
+                        item, end = decoder.raw_decode(buffer, position)
+                    except simplejson.JSONDecodeError:
+                        if fill():
+                            continue
+                        raise
+                    if end == len(buffer) and fill():
+                        continue
+                    break
+                position = end
+                yield item
+                separator = skip_whitespace()
+                position += 1
+                if separator == ']':
+                    break
+                if separator != ',':
+                    raise simplejson.JSONDecodeError("Expecting ',' delimiter", buffer, position - 1)
+                skip_whitespace()
+        if skip_whitespace() != '':
+            raise simplejson.JSONDecodeError("Extra data", buffer, position)
+
+
+CONFIG_SUFFIX = '_config.json'
+
+
+# Operating systems with data in datapath, found by their config files
+def discover_operatingsystems(datapath: str) -> List[str]:
+    return sorted(name[:-len(CONFIG_SUFFIX)] for name in os.listdir(datapath) if name.endswith(CONFIG_SUFFIX) and name != CONFIG_SUFFIX)
+
+
+def data_filenames(datapath: str, operatingsystem: str) -> List[str]:
+    return [os.path.join(datapath, "{}_{}.json".format(operatingsystem, kind)) for kind in ('config', 'errata')]
+
+
+# Hash of the raw data files; identifies the source of a snapshot and the version of the data
+def source_hash(datapath: str, operatingsystem: str) -> str:
+    hasher = hashlib.sha256()
+    for filename in data_filenames(datapath, operatingsystem):
+        with open(filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# Cheap identity of files, compared to tell whether they need to be read again
+# Missing files are None. Files replaced by a rename get a new inode, but a
+# file rewritten in place within the resolution of the file system clock may
+# keep its fingerprint; the caller has to account for that using mtime.
+def file_fingerprint(filenames: List[str]) -> Tuple[Optional[Tuple[int, int, int]], ...]:
+    fingerprint = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            fingerprint.append(None)
+        else:
+            fingerprint.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+# This is supposed to throw an exception if something is wrong
+def validate_erratum(item: Any) -> Dict:
+    assert isinstance(item, dict), "Erratum should be a dict"
+    assert isinstance(item['packages'], list), "Erratum must have a 'packages' list"
+    for package in item['packages']:
+        assert isinstance(package, dict), "Erratum's package must be a dict"
+        assert isinstance(package['release'], str), "Erratum's package must have 'release'"
+        assert isinstance(package['component'], str), "Erratum's package must have 'component'"
+        assert isinstance(package['architecture'], str), "Erratum's package must have 'architecture'"
+    return item
+
+
+def validate_config(config: Any) -> Tuple[Set, Set, Set, Dict]:
+    releases: Set = set()
+    components: Set = set()
+    architectures: Set = set()
+    release_aliases: Dict = {}
+    assert isinstance(config, dict), "Config must be a dict"
+    releases_dict = config['releases']
+    assert isinstance(releases_dict, dict), "'releases' must be a dict"
+    for release_name, release in releases_dict.items():
+        assert isinstance(release_name, str), "releases-key must be a string"
+        assert isinstance(release, dict), "releases-value must be a dict"
+        aliases = release.get('aliases', [])
+        assert isinstance(aliases, list), "'aliases' must be a list"
+        for alias in aliases:
+            assert isinstance(alias, str), "'aliases'-value must be a string"
+            assert alias not in release_aliases, "'aliases'-value must not exist twice"
+            release_aliases[alias] = release_name
+        # Make the map idempotent for convenience
+        release_aliases[release_name] = release_name
+        assert isinstance(release['components'], list), "'components' must be a list"
+        components.update(release['components'])
+        assert isinstance(release['architectures'], list), "'architectures' must be a list"
+        architectures.update(release['architectures'])
+    releases.update(releases_dict.keys())
+    for item in components:
+        assert isinstance(item, str), "'components'-value must be a string"
+    for item in architectures:
+        assert isinstance(item, str), "'architectures'-value must be a string"
+    return releases, components, architectures, release_aliases
+
+
+# The parsed, validated and serialized data files of one operating system
+#
+# data holds a Retained instead of the SerializedErratum for every erratum
+# that is unchanged compared to the digests passed to load_data; resolve
+# replaces those with the already loaded objects.
+class LoadedData:
+    def __init__(
+        self,
+        config: Tuple[Set, Set, Set, Dict],
+        data: List[Union[SerializedErratum, Retained]],
+        index: ErrataIndex,
+        etag_base: str,
+        source: str,
+        diff: Optional[ErrataDiff],
+        timings: Dict[str, float],
+    ) -> None:
+        self.releases, self.components, self.architectures, self.release_aliases = config
+        self.data = data
+        self.index = index
+        self.etag_base = etag_base
+        self.source = source
+        self.diff = diff
+        self.timings = timings
+
+    def resolve(self, old: Optional[List[SerializedErratum]]) -> List[SerializedErratum]:
+        if self.diff is not None:
+            old_by_name = {item.name: item for item in old}
+            for name in self.diff.previous:
+                self.diff.add_previous(old_by_name[name])
+            self.data = [old[item.position] if isinstance(item, Retained) else item for item in self.data]
+        return self.data
+
+
+# The errata file is parsed as a stream; every erratum is validated, serialized
+# and indexed right away, so only the resulting data is kept in memory.
+def load_data(datapath: str, operatingsystem: str, digests: Optional[Dict[str, bytes]] = None) -> LoadedData:
+    timings: Dict[str, float] = {}
+    start = time.monotonic()
+
+    def lap(stage: str) -> None:
+        nonlocal start
+        now = time.monotonic()
+        timings[stage] = timings.get(stage, 0.0) + now - start
+        start = now
+
+    # the raw bytes are hashed while they are read; the hash is both the data version and the snapshot source
+    config_filename, errata_filename = data_filenames(datapath, operatingsystem)
+    source = hashlib.sha256()
+    config = validate_config(read_json(config_filename, source))
+    lap('read config')
+    serializer = ErrataSerializer(digests)
+    index = ErrataIndex()
+    for stage in ('read errata', 'validate', 'serialize', 'index'):
+        timings[stage] = 0.0
+    for item in iter_json_list(errata_filename, source):
+        lap('read errata')
+        validate_erratum(item)
+        lap('validate')
+        serializer.add(item)
+        lap('serialize')
+        index.add(item)
+        lap('index')
+    lap('read errata')
+    data, diff = serializer.finish()
+    lap('serialize')
+    return LoadedData(config, data, index, source.hexdigest(), source.hexdigest(), diff, timings)
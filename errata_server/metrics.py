@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+)
+
+from twisted.web import resource
+from twisted.web.http import Request
+
+from errata_server.store import DataStore
+
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+PHASES = ('filter', 'serialize', 'write')
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name: str, labels: Tuple[Tuple[str, str], ...], value: float) -> str:
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(key, _escape(str(label))) for key, label in labels) + '}'
+    return '{} {}'.format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: Tuple[Tuple[str, str], ...]) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield _sample(name + '_bucket', labels + (('le', repr(float(bound))),), cumulative)
+        yield _sample(name + '_bucket', labels + (('le', '+Inf'),), self.count)
+        yield _sample(name + '_sum', labels, self.sum)
+        yield _sample(name + '_count', labels, self.count)
+
+
+# Request metrics of a single endpoint
+#
+# Requests are counted by status code; a 304 is a request answered by etag.
+# Coalesced requests got their response from a concurrent identical request.
+# The time spent is recorded per phase: filtering the errata, serializing
+# (joining and compressing) the response, and writing it to the client.
+# Responses served from the cache only have a write phase.
+class EndpointMetrics:
+    def __init__(self, api: str, operatingsystem: str, labels: Tuple[Tuple[str, str], ...] = ()) -> None:
+        self.labels = labels + (('api', api), ('operatingsystem', operatingsystem))
+        self.requests: Dict[int, int] = {}
+        self.coalesced = 0
+        self.phases = {phase: Histogram(LATENCY_BUCKETS) for phase in PHASES}
+        self.sizes = Histogram(SIZE_BUCKETS)
+
+    def observe_request(self, code: int) -> None:
+        self.requests[code] = self.requests.get(code, 0) + 1
+
+    def observe_coalesced(self) -> None:
+        self.coalesced += 1
+
+    @contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[phase].observe(time.monotonic() - start)
+
+    def observe_size(self, size: int) -> None:
+        self.sizes.observe(size)
+
+
+# The metrics of one process
+# With several workers, every worker only exports the metrics of its own
+# requests, which labels tells apart (see main).
+class Metrics:
+    def __init__(self, labels: Tuple[Tuple[str, str], ...] = ()) -> None:
+        self.labels = labels
+        self.endpoints: List[EndpointMetrics] = []
+
+    def endpoint(self, api: str, operatingsystem: str) -> EndpointMetrics:
+        metrics = EndpointMetrics(api, operatingsystem, self.labels)
+        self.endpoints.append(metrics)
+        return metrics
+
+
+# Render all metrics in the Prometheus text exposition format
+def render_metrics(metrics: Metrics, stores: Dict[str, DataStore]) -> bytes:
+    lines: List[str] = []
+
+    def family(name: str, kind: str, description: str) -> None:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    family('errata_requests_total', 'counter', 'Requests handled by status code')
+    for endpoint in metrics.endpoints:
+        for code, count in sorted(endpoint.requests.items()):
+            lines.append(_sample('errata_requests_total', endpoint.labels + (('code', str(code)),), count))
+    family('errata_coalesced_requests_total', 'counter', 'Requests sharing the response of a concurrent identical request')
+    for endpoint in metrics.endpoints:
+        lines.append(_sample('errata_coalesced_requests_total', endpoint.labels, endpoint.coalesced))
+    family('errata_request_phase_seconds', 'histogram', 'Time spent per phase of building and sending responses')
+    for endpoint in metrics.endpoints:
+        for phase, histogram in endpoint.phases.items():
+            lines.extend(histogram.samples('errata_request_phase_seconds', endpoint.labels + (('phase', phase),)))
+    family('errata_response_bytes', 'histogram', 'Size of response bodies as sent')
+    for endpoint in metrics.endpoints:
+        lines.extend(endpoint.sizes.samples('errata_response_bytes', endpoint.labels))
+
+    stores_labels = [(metrics.labels + (('operatingsystem', operatingsystem),), store) for operatingsystem, store in sorted(stores.items())]
+    family('errata_reloads_total', 'counter', 'Completed data reloads')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_reloads_total', labels, store.reloads))
+    family('errata_reloads_skipped_total', 'counter', 'Reloads skipped as the data files were unchanged')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_reloads_skipped_total', labels, store.skipped_reloads))
+    family('errata_reload_stage_seconds', 'gauge', 'Duration of the stages of the last data reload')
+    for labels, store in stores_labels:
+        for stage, duration in store.timings.items():
+            lines.append(_sample('errata_reload_stage_seconds', labels + (('stage', stage),), duration))
+    family('errata_reload_offloaded_seconds_total', 'counter', 'Reload time spent outside the event loop')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_reload_offloaded_seconds_total', labels, store.offloaded_time))
+    family('errata_evictions_total', 'counter', 'Data evictions of idle operating systems')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_evictions_total', labels, store.evictions))
+    generations_labels = [(labels, store.current) for labels, store in stores_labels if store.current is not None]
+    family('errata_errata', 'gauge', 'Errata currently loaded')
+    for labels, generation in generations_labels:
+        lines.append(_sample('errata_errata', labels, len(generation.data)))
+    family('errata_packages', 'gauge', 'Packages of the errata currently loaded')
+    for labels, generation in generations_labels:
+        lines.append(_sample('errata_packages', labels, len(generation.index)))
+    family('errata_index_bytes', 'gauge', 'Memory used by the package index')
+    for labels, generation in generations_labels:
+        lines.append(_sample('errata_index_bytes', labels, generation.index.memory_usage()))
+    family('errata_cache_entries', 'gauge', 'Cached responses')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_cache_entries', labels, len(store.cache)))
+    family('errata_cache_bytes', 'gauge', 'Size of cached responses')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_cache_bytes', labels, store.cache.size))
+    family('errata_cache_hits_total', 'counter', 'Responses served from the cache')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_cache_hits_total', labels, store.cache.hits))
+    family('errata_cache_misses_total', 'counter', 'Responses missing from the cache')
+    for labels, store in stores_labels:
+        lines.append(_sample('errata_cache_misses_total', labels, store.cache.misses))
+    family('errata_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits')
+    for labels, store in stores_labels:
+        lookups = store.cache.hits + store.cache.misses
+        lines.append(_sample('errata_cache_hit_ratio', labels, store.cache.hits / lookups if lookups else 0.0))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: Metrics, stores: Dict[str, DataStore]) -> None:
+        super(MetricsResource, self).__init__()
+        self.metrics = metrics
+        self.stores = stores
+
+    def render_GET(self, request: Request) -> bytes:
+        request.setHeader(b'content-type', CONTENT_TYPE)
+        return render_metrics(self.metrics, self.stores)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Optional,
+)
+
+from twisted.internet import inotify
+from twisted.python import filepath, log
+
+from errata_server.loader import CONFIG_SUFFIX, discover_operatingsystems
+from errata_server.store import WATCH_MASK, DataStore
+
+
+# The data stores of all operating systems found in datapath
+#
+# Operating systems are discovered from the <os>_config.json files in
+# datapath, including those appearing while the server runs. The store of
+# an operating system is created on the first request for it, and loads its
+# data right away; only the stores of warm_up, or all with eager, are
+# created in advance. With idle_timeout, the data of stores that were not
+# requested for that many seconds is evicted, except for warm_up.
+#
+# stores only holds the stores created so far. A single inotify watch
+# serves the discovery and all stores; options are passed on to the stores.
+class DataStores:
+    def __init__(
+        self,
+        datapath: str,
+        options: Dict[str, Any],
+        warm_up: Collection[str] = (),
+        eager: bool = False,
+        idle_timeout: Optional[float] = None,
+    ) -> None:
+        self.datapath = datapath
+        self.options = options
+        self.warm_up = frozenset(warm_up)
+        self.eager = eager
+        self.idle_timeout = idle_timeout
+        self.stores: Dict[str, DataStore] = {}
+        self.operatingsystems = set(discover_operatingsystems(datapath))
+        log.msg("Found operatingsystems: {}".format(', '.join(sorted(self.operatingsystems)) or 'none'))
+
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        self.notifier.watch(filepath.FilePath(datapath), mask=WATCH_MASK, callbacks=[self.notify])
+        if options.get('follow'):
+            self.notifier.watch(filepath.FilePath(options['snapshot_path']), mask=WATCH_MASK, callbacks=[self.notify])
+
+        for operatingsystem in sorted(self.operatingsystems if eager else self.warm_up):
+            self.get(operatingsystem)
+        if idle_timeout:
+            asyncio.get_event_loop().call_later(idle_timeout / 2, self.evict_idle)
+
+    # The store of the given operating system, or None if there is no data for it
+    def get(self, operatingsystem: str) -> Optional[DataStore]:
+        store = self.stores.get(operatingsystem)
+        if store is None:
+            if operatingsystem not in self.operatingsystems:
+                return None
+            store = self.stores[operatingsystem] = DataStore(operatingsystem, self.datapath, watch=False, **self.options)
+        return store
+
+    def evict_idle(self) -> None:
+        idle = time.monotonic() - self.idle_timeout
+        for operatingsystem, store in self.stores.items():
+            if operatingsystem not in self.warm_up and store.current is not None and store.last_used < idle:
+                store.evict()
+        asyncio.get_event_loop().call_later(self.idle_timeout / 2, self.evict_idle)
+
+    # Callbacks
+
+    def notify(self, ignored: Any, path: filepath.FilePath, mask: int) -> None:
+        for store in list(self.stores.values()):
+            store.notify(ignored, path, mask)
+        # new operating systems are only served once their config file is complete
+        name = path.basename().decode('utf8', 'replace')
+        if name.endswith(CONFIG_SUFFIX) and name != CONFIG_SUFFIX and mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            operatingsystem = name[:-len(CONFIG_SUFFIX)]
+            if operatingsystem not in self.operatingsystems:
+                log.msg("Found new operatingsystem {}".format(operatingsystem))
+                self.operatingsystems.add(operatingsystem)
+                if self.eager or operatingsystem in self.warm_up:
+                    self.get(operatingsystem)
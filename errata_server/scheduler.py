@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from typing import (
+    Awaitable,
+    Callable,
+    Optional,
+)
+
+
+# Runs reloads in response to bursts of file system events
+#
+# Every event restarts a timer, and the reload only starts once no further
+# event came in for a while. Events announcing a complete file (closed after
+# writing or renamed into place) wait for delay; modifications of a file that
+# is still being written wait for the much longer settle_delay, so a half
+# written file is only parsed if its writer went quiet without closing it.
+#
+# At most one reload runs at a time. Events during a reload queue a single
+# further reload, which starts once the running one is done.
+class ReloadScheduler:
+    def __init__(self, reload: Callable[[], Awaitable[None]], delay: float = 1.0, settle_delay: float = 10.0) -> None:
+        self.reload = reload
+        self.delay = delay
+        self.settle_delay = settle_delay
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.running: Optional[asyncio.Future] = None
+        self.queued = False
+
+    def schedule(self, complete: bool = True) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_event_loop().call_later(self.delay if complete else self.settle_delay, self.start)
+
+    def start(self) -> None:
+        self.timer = None
+        if self.running is not None:
+            self.queued = True
+            return
+        self.running = asyncio.ensure_future(self.reload())
+        self.running.add_done_callback(self.done)
+
+    def done(self, _: asyncio.Future) -> None:
+        self.running = None
+        if self.queued:
+            self.queued = False
+            self.start()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import time
+import struct
+import tempfile
+import simplejson
+
+from array import array
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from errata_server.fragments import DIGEST_SIZE, SerializedErratum
+from errata_server.index import KEY_NAMES, ErrataIndex, key_positions
+from errata_server.loader import LoadedData, source_hash
+
+
+# Binary snapshot of the loaded data of one operating system
+#
+# Layout: magic, format version and header length (PREFIX), a JSON header,
+# followed by the raw sections listed in the header. Sections are either
+# plain byte blobs or native arrays; the header records byte order and item
+# size, and a snapshot written on a different platform is considered stale.
+# The header is padded and every section aligned to ALIGNMENT bytes, so the
+# arrays can be used in place: erratum bodies as well as the arrays of the
+# index are served directly from the memory mapped file, which the processes
+# following the snapshot share.
+
+MAGIC = b'ERRSNAP\0'
+VERSION = 6
+PREFIX = struct.Struct('<8sII')
+ALIGNMENT = 8
+
+
+def _align(position: int) -> int:
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def snapshot_filename(path: str, operatingsystem: str) -> str:
+    return os.path.join(path, "{}_errata.snapshot".format(operatingsystem))
+
+
+def write_snapshot(filename: str, loaded: LoadedData) -> None:
+    data, index = loaded.data, loaded.index
+    body_offsets = array('Q', [0])
+    for item in data:
+        body_offsets.append(body_offsets[-1] + len(item.body))
+    package_offsets = array('I')
+    for item in data:
+        package_offsets.extend(item.offsets)
+    # the errata positions of all keys of an index, concatenated in the order of the keys
+    key_sections = []
+    for name, keys in zip(KEY_NAMES, index.keys):
+        key_offsets, key_errata = array('I', [0]), array('I')
+        for entry in keys.values():
+            key_errata.extend(key_positions(entry))
+            key_offsets.append(len(key_errata))
+        key_sections.extend([(name + '_key_offsets', [key_offsets]), (name + '_key_errata', [key_errata])])
+
+    sections: List[Tuple[str, List]] = [
+        ('bodies', [item.body for item in data]),
+        ('body_offsets', [body_offsets]),
+        ('package_offsets', [package_offsets]),
+        ('digests', [item.digest for item in data]),
+        ('issued', [array('l', (item.issued for item in data))]),
+        ('index_offsets', [index.offsets]),
+        ('release_codes', [index.columns[0]]),
+        ('component_codes', [index.columns[1]]),
+        ('architecture_codes', [index.columns[2]]),
+    ] + key_sections
+    layout: Dict[str, Tuple[int, int]] = {}
+    position = 0
+    for name, parts in sections:
+        length = sum(memoryview(part).nbytes for part in parts)
+        position = _align(position)
+        layout[name] = (position, length)
+        position += length
+    header = simplejson.dumps({
+        'source': loaded.source,
+        'etag_base': loaded.etag_base,
+        'byteorder': sys.byteorder,
+        'itemsize': array('I').itemsize,
+        'releases': sorted(loaded.releases),
+        'components': sorted(loaded.components),
+        'architectures': sorted(loaded.architectures),
+        'release_aliases': loaded.release_aliases,
+        'names': [item.name for item in data],
+        # index values in code order
+        'values': [sorted(values, key=values.get) for values in index.values],
+        'keys': [list(keys) for keys in index.keys],
+        'sections': layout,
+    }).encode('utf-8')
+    # JSON allows trailing whitespace
+    header += b' ' * (_align(PREFIX.size + len(header)) - PREFIX.size - len(header))
+
+    # write to a temporary file first, so readers never map a partial snapshot
+    fd, temporary = tempfile.mkstemp(prefix='.snapshot', dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as snapshot:
+            snapshot.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+            snapshot.write(header)
+            position = 0
+            for name, parts in sections:
+                snapshot.write(b'\0' * (layout[name][0] - position))
+                for part in parts:
+                    snapshot.write(part)
+                position = sum(layout[name])
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+# Load the snapshot if it was built from the current data files; returns None if it is missing or stale
+# Without verify, the snapshot is trusted to be current, and the data files are not read at all.
+def load_snapshot(filename: str, datapath: str, operatingsystem: str, verify: bool = True) -> Optional[LoadedData]:
+    start = time.monotonic()
+    try:
+        with open(filename, 'rb') as fd:
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    magic, version, header_length = PREFIX.unpack_from(mapped)
+    if magic != MAGIC or version != VERSION:
+        return None
+    header = simplejson.loads(mapped[PREFIX.size:PREFIX.size + header_length])
+    if header['byteorder'] != sys.byteorder or header['itemsize'] != array('I').itemsize:
+        return None
+    source = source_hash(datapath, operatingsystem) if verify else header['source']
+    if header['source'] != source:
+        return None
+    timings = {'hash': time.monotonic() - start}
+
+    view = memoryview(mapped)
+    base = PREFIX.size + header_length
+
+    def section(name: str) -> memoryview:
+        offset, length = header['sections'][name]
+        return view[base + offset:base + offset + length]
+
+    # the arrays are not copied, and slices of them are views as well
+    def section_array(name: str, typecode: str) -> memoryview:
+        return section(name).cast(typecode)
+
+    bodies = section('bodies')
+    digests = section('digests')
+    issued = section_array('issued', 'l')
+    body_offsets = section_array('body_offsets', 'Q')
+    package_offsets = section_array('package_offsets', 'I')
+    index_offsets = section_array('index_offsets', 'I')
+    columns = [section_array(name, 'H') for name in ('release_codes', 'component_codes', 'architecture_codes')]
+    data = [
+        SerializedErratum.restore(
+            name,
+            bodies[body_offsets[position]:body_offsets[position + 1]],
+            # every erratum has one package offset more than packages
+            package_offsets[index_offsets[position] + position:index_offsets[position + 1] + position + 1],
+            bytes(digests[DIGEST_SIZE * position:DIGEST_SIZE * (position + 1)]),
+            issued[position],
+        )
+        for position, name in enumerate(header['names'])
+    ]
+    keys = []
+    for name, values in zip(KEY_NAMES, header['keys']):
+        key_offsets, key_errata = section_array(name + '_key_offsets', 'I'), section_array(name + '_key_errata', 'I')
+        keys.append({
+            value: key_errata[start] if end - start == 1 else key_errata[start:end]
+            for value, start, end in zip(values, key_offsets, key_offsets[1:])
+        })
+    index = ErrataIndex.restore(index_offsets, header['values'], columns, keys)
+    config = (set(header['releases']), set(header['components']), set(header['architectures']), header['release_aliases'])
+    timings['read snapshot'] = time.monotonic() - start - timings['hash']
+    return LoadedData(config, data, index, header['etag_base'], source, None, timings)
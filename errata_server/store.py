@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import asyncio
+import hashlib
+import simplejson
+
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from twisted.internet import inotify
+from twisted.python import filepath, log
+
+from errata_server.cache import ResponseCache, SingleFlight
+from errata_server.fragments import SerializedErratum, parse_date
+from errata_server.index import KEY_NAMES, ErrataIndex, filter_batch, filter_fragments
+from errata_server.loader import LoadedData, data_filenames, file_fingerprint, load_data, source_hash
+from errata_server.scheduler import ReloadScheduler
+from errata_server.snapshot import load_snapshot, snapshot_filename, write_snapshot
+
+
+# wanted releases, components, architectures, binary packages, source packages and CVE ids
+Filters = Tuple[Optional[FrozenSet], Optional[FrozenSet], Optional[FrozenSet], Optional[FrozenSet], Optional[FrozenSet], Optional[FrozenSet]]
+FILTER_NAMES = (b'releases', b'components', b'architectures') + tuple(name.encode('utf-8') for name in KEY_NAMES)
+Fingerprint = Tuple[Optional[Tuple[int, int, int]], ...]
+
+# files are complete once closed after writing or renamed into place
+WATCH_MASK = inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+
+# etags memoized per generation; clients choose the filters, so the least recently used are dropped beyond that
+ETAGS_SIZE = 1024
+
+# files modified less than this many nanoseconds before taking their fingerprint may change again unnoticed
+RACY_INTERVAL = 2 * 10 ** 9
+
+
+# Selects the errata changed after the given generation, or issued on or after the given day
+# Being a tuple, it can be part of cache keys.
+class Since(NamedTuple):
+    attribute: str
+    value: int
+
+    def __call__(self, item: SerializedErratum) -> bool:
+        if self.attribute == 'generation':
+            return item.generation > self.value
+        return item.issued >= self.value
+
+
+# make sure we have a list of entries without leading or trailing whitespaces
+def sanitize_query_list(query_list: List[bytearray]) -> Set[str]:
+    return set(entry.strip() for entry in b','.join(query_list).decode('utf-8').split(','))
+
+
+# Turn the body of a batch request, a JSON list of filter sets, into query parameters
+# A filter set is an object with any of the query parameters filtering
+# errata, each a list of values or a comma separated string.
+def parse_batch(body: bytes) -> List[Dict[bytes, List[bytes]]]:
+    filter_sets = simplejson.loads(body)
+    assert isinstance(filter_sets, list), "Batch must be a list"
+    queries = []
+    for filter_set in filter_sets:
+        assert isinstance(filter_set, dict), "Filter set must be an object"
+        query = {}
+        for key, values in filter_set.items():
+            name = key.encode('utf-8')
+            assert name in FILTER_NAMES, "Unknown filter '{}'".format(key)
+            if isinstance(values, str):
+                values = [values]
+            assert isinstance(values, list) and all(isinstance(value, str) for value in values), "'{}'-value must be a list of strings".format(key)
+            query[name] = [value.encode('utf-8') for value in values]
+        queries.append(query)
+    return queries
+
+
+# One immutable generation of the data of an operating system
+#
+# Everything a request needs is reachable from its generation, which the
+# store replaces with a single assignment on every reload. Requests pin the
+# generation they started with, so they never mix the config, data and hash
+# of different reloads, and an old generation is freed as soon as its last
+# request is done. etags only memoizes values derived from the generation,
+# bounded to ETAGS_SIZE entries like the response cache.
+class Generation:
+    __slots__ = ('number', 'releases', 'components', 'architectures', 'release_aliases', 'data', 'index', 'etag_base', 'etags')
+
+    def __init__(
+        self,
+        number: int,
+        config: Tuple[Set, Set, Set, Dict],
+        data: List[SerializedErratum],
+        index: ErrataIndex,
+        etag_base: bytes,
+        etags: OrderedDict,
+    ) -> None:
+        self.number = number
+        self.releases, self.components, self.architectures, self.release_aliases = config
+        self.data = data
+        self.index = index
+        self.etag_base = etag_base
+        self.etags = etags
+
+    # Resolve the query parameters to the canonical filter (see Filters)
+    # Absent parameters stay None, so the result can be used as a cache key.
+    def resolve_filters(self, query: Dict[bytes, List[bytes]]) -> Filters:
+        releases = None
+        if b'releases' in query:
+            releases = frozenset(self.release_aliases.get(release) for release in sanitize_query_list(query[b'releases'])) & self.releases
+
+        components = None
+        if b'components' in query:
+            components = frozenset(sanitize_query_list(query[b'components'])) & self.components
+
+        architectures = None
+        if b'architectures' in query:
+            architectures = frozenset(sanitize_query_list(query[b'architectures']) | {'all'}) & self.architectures
+
+        # unknown keys match no errata, so they are dropped like unknown releases
+        keys = tuple(
+            frozenset(value for value in sanitize_query_list(query[name]) if value in known) if name in query else None
+            for name, known in zip(FILTER_NAMES[3:], self.index.keys)
+        )
+
+        return (releases, components, architectures) + keys
+
+    # The etag only depends on the data and the resolved filter, so it is memoized per generation.
+    def get_etag(self, filters: Filters) -> bytes:
+        etag = self.etags.get(filters)
+        if etag is not None:
+            self.etags.move_to_end(filters)
+        else:
+            hasher = hashlib.sha256()
+            hasher.update(self.etag_base)
+            for name, values in zip(FILTER_NAMES, filters):
+                if values is not None:
+                    hasher.update(b'&' + name + b'=' + ','.join(sorted(values)).encode('utf-8'))
+            etag = self.etags[filters] = hasher.hexdigest().encode('utf-8')
+            while len(self.etags) > ETAGS_SIZE:
+                self.etags.popitem(last=False)
+        return etag
+
+    def filter(self, filters: Filters, predicate: Optional[Callable[[SerializedErratum], bool]] = None) -> List[bytes]:
+        return filter_fragments(self.data, self.index, filters, predicate)
+
+    def filter_batch(self, filter_sets: List[Filters]) -> Tuple[List[bytes], List[List[int]]]:
+        return filter_batch(self.data, self.index, filter_sets)
+
+
+# In memory database of the errata of one operating system
+#
+# A single store is shared by the endpoints of all api versions serving the
+# same operating system, so the data files are watched, parsed and indexed
+# only once. Responses are cached here as well, as all api versions render
+# the same JSON; cache keys are pairs of resolved filters and content coding.
+#
+# Without write_snapshots, existing snapshots are still loaded, but stale ones
+# are not replaced. A store that follows only loads the snapshots another
+# process writes to snapshot_path, and reloads whenever a new one appears there. This way
+# several serving processes share the memory mapped erratum bodies and
+# switch to new data together.
+#
+# Every reload swaps in a new Generation, and each erratum records the
+# number of the generation it was last changed in. The etag bases of the last history_size
+# generations are kept, so clients can ask for the errata changed since a
+# data version they have seen before.
+#
+# The etag base of a generation is the hash of the raw data files. Reloads
+# are skipped while the data files keep their size, mtime and inode; with
+# verify, the content hash decides instead.
+#
+# A lazy store only loads its data on the first request, and evict drops
+# the data again until the next one. Without watch, the owner of the store
+# has to pass on the inotify events of the data files to notify.
+class DataStore:
+    def __init__(
+        self,
+        operatingsystem: str,
+        datapath: str,
+        cache_size: int = 64,
+        cache_bytes: int = 64 * 1024 * 1024,
+        executor: Optional[Executor] = None,
+        snapshot_path: Optional[str] = None,
+        write_snapshots: bool = True,
+        follow: bool = False,
+        history_size: int = 16,
+        verify: bool = False,
+        reload_delay: float = 1.0,
+        lazy: bool = False,
+        watch: bool = True,
+    ) -> None:
+        # initialize in memory database
+        self.operatingsystem = operatingsystem
+        self.datapath = datapath
+        self.current: Optional[Generation] = None
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache = ResponseCache(cache_size, cache_bytes)
+        self.flights = SingleFlight()
+        self.data_lock = asyncio.Lock()
+        self.executor = executor
+        self.snapshot_path = snapshot_path
+        self.write_snapshots = write_snapshots
+        self.follow = follow
+        self.timings: Dict[str, float] = dict()
+        self.offloaded_time = 0.0
+        self.history_size = history_size
+        self.versions: OrderedDict = OrderedDict()
+        self.verify = verify
+        self.fingerprint: Optional[Tuple[Fingerprint, bool]] = None
+        self.source: Optional[str] = None
+        self.skipped_reloads = 0
+        self.reloads = 0
+        self.evictions = 0
+        self.last_used = time.monotonic()
+
+        # set up data directory notifier; bursts of events cause a single reload
+        if follow:
+            self.watched = {os.path.basename(snapshot_filename(snapshot_path, operatingsystem)).encode('utf8')}
+        else:
+            self.watched = {os.path.basename(filename).encode('utf8') for filename in data_filenames(datapath, operatingsystem)}
+        self.scheduler = ReloadScheduler(self.read_data, reload_delay, 10 * reload_delay)
+        if watch:
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            self.notifier.watch(filepath.FilePath(snapshot_path if follow else datapath), mask=WATCH_MASK, callbacks=[self.notify])
+
+        # read initial data
+        self.read_task: Optional[asyncio.Future] = None
+        if not lazy:
+            self.load()
+
+    # Start reading the data, unless that already happened
+    def load(self) -> asyncio.Future:
+        if self.read_task is None:
+            self.read_task = asyncio.ensure_future(self.read_data())
+        return self.read_task
+
+    # Drop the data until the next request; requests still using it keep their generation
+    # Returns whether the data was dropped, which is not done while it is being read or a reload is pending.
+    def evict(self) -> bool:
+        if self.read_task is None or not self.read_task.done():
+            return False
+        scheduler = self.scheduler
+        if scheduler.running is not None or scheduler.timer is not None or scheduler.queued:
+            return False
+        log.msg("Evicting data of operatingsystem {}".format(self.operatingsystem))
+        cache = ResponseCache(self.cache_size, self.cache_bytes)
+        cache.hits, cache.misses = self.cache.hits, self.cache.misses
+        self.current, self.cache = None, cache
+        # the files are read again on the next request
+        self.read_task = self.fingerprint = self.source = None
+        self.evictions += 1
+        return True
+
+    # Wait for the initial data; returns the current generation, or None if there is no data
+    async def wait_ready(self, timeout: float) -> Optional[Generation]:
+        self.last_used = time.monotonic()
+        if self.current is None:
+            self.load()
+            try:
+                # a single impatient request must not cancel the shared read
+                await asyncio.wait_for(asyncio.shield(self.read_task), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.current
+
+    # Resolve the since query parameter to a predicate selecting the errata changed since then
+    # since is either the etag base of a recent generation or a date compared to the issued date.
+    # Returns None for unknown versions, in which case all errata are to be delivered.
+    def resolve_since(self, query: Dict[bytes, List[bytes]]) -> Optional[Since]:
+        if b'since' not in query:
+            return None
+        since = query[b'since'][-1].strip()
+        generation = self.versions.get(since)
+        if generation is not None:
+            return Since('generation', generation)
+        issued = parse_date(since.decode('utf-8'))
+        if issued:
+            return Since('issued', issued)
+        return None
+
+    async def read_data(self) -> None:
+        async with self.data_lock:
+            try:
+                log.msg("Reading data for operatingsystem {}".format(self.operatingsystem))
+                # unchanged errata are identified by digest, so they need not be sent back from the worker
+                current = self.current
+                loop = asyncio.get_event_loop()
+                fingerprint = self.take_fingerprint()
+                if current is not None and await loop.run_in_executor(None, self.is_unchanged, fingerprint):
+                    self.skipped_reloads += 1
+                    log.msg("Data of operatingsystem {} is unchanged".format(self.operatingsystem))
+                    return
+                digests = None
+                if current is not None and all(isinstance(item.name, str) for item in current.data):
+                    digests = {item.name: item.digest for item in current.data}
+                    if len(digests) != len(current.data):
+                        digests = None
+                loaded = None
+                if self.snapshot_path is not None:
+                    loaded = await loop.run_in_executor(None, self.read_snapshot)
+                stale_snapshot = self.snapshot_path is not None and loaded is None and self.write_snapshots and not self.follow
+                if loaded is None:
+                    if self.follow:
+                        log.msg("No snapshot for operatingsystem {} yet".format(self.operatingsystem))
+                        return
+                    loaded = await loop.run_in_executor(self.executor, load_data, self.datapath, self.operatingsystem, digests)
+                start = time.monotonic()
+                log.msg("Found releases: {}; components: {}; architectures: {}".format(loaded.releases, loaded.components, loaded.architectures))
+                log.msg("Release aliases: {}".format(loaded.release_aliases))
+                new_data = loaded.resolve(current.data if current is not None else None)
+                diff = loaded.diff
+                if diff is not None:
+                    log.msg("Changes for operatingsystem {}: {}".format(self.operatingsystem, diff))
+                log.msg("Pivoting data for operatingsystem {}".format(self.operatingsystem))
+                log.msg("Index of {} packages uses {} bytes".format(len(loaded.index), loaded.index.memory_usage()))
+                # responses (and their etags) to filters not matching any changed erratum stay valid
+                cache, etags = self.cache, OrderedDict()
+                if diff is not None and diff.incremental:
+                    cached = len(cache)
+                    log.msg("Dropped {} of {} cached responses".format(cache.discard(lambda key: diff.affects(key[0])), cached))
+                    etags = OrderedDict((filters, etag) for filters, etag in current.etags.items() if not diff.affects(filters))
+                else:
+                    log.msg("Dropping response cache ({})".format(cache))
+                    cache = ResponseCache(self.cache_size, self.cache_bytes)
+                    # hit and miss counts are exported as metrics, so they keep counting
+                    cache.hits, cache.misses = self.cache.hits, self.cache.misses
+                # unchanged errata keep the generation they were last changed in
+                number = self.reloads + 1
+                previous = {item.name: item for item in current.data} if current is not None else {}
+                for item in new_data:
+                    known = previous.get(item.name)
+                    item.generation = known.generation if known is not None and known.digest == item.digest else number
+                log.msg("Hash of new data: {}".format(loaded.etag_base))
+                config = (loaded.releases, loaded.components, loaded.architectures, loaded.release_aliases)
+                generation = Generation(number, config, new_data, loaded.index, loaded.etag_base.encode('utf-8'), etags)
+                self.current, self.cache, self.reloads = generation, cache, number
+                self.fingerprint, self.source = fingerprint, loaded.source
+                # the old generation is freed once the last request pinning it is done
+                del current, previous
+                self.versions[generation.etag_base] = number
+                self.versions.move_to_end(generation.etag_base)
+                while len(self.versions) > self.history_size:
+                    self.versions.popitem(last=False)
+                # everything done in the worker would otherwise have blocked the event loop
+                self.timings = loaded.timings
+                self.timings['pivot'] = time.monotonic() - start
+                self.offloaded_time += sum(loaded.timings.values()) - self.timings['pivot']
+                log.msg("Reloaded operatingsystem {} ({}); {:.3f}s of event loop time saved in total".format(
+                    self.operatingsystem,
+                    ', '.join("{} {:.3f}s".format(stage, duration) for stage, duration in self.timings.items()),
+                    self.offloaded_time,
+                ))
+            except Exception as e:
+                log.err("An Exception occurred while reading data for operatingsystem {} ({})".format(self.operatingsystem, e))
+                return
+            if stale_snapshot:
+                await loop.run_in_executor(None, self.write_snapshot, loaded)
+
+    # Fingerprint of the files the next generation is going to be loaded from
+    # The fingerprint is taken before reading the files, so changes made while
+    # reading are noticed on the next reload.
+    def take_fingerprint(self) -> Tuple[Fingerprint, bool]:
+        now = time.time_ns()
+        if self.follow:
+            # snapshots are always replaced by a rename, so their inode changes
+            return file_fingerprint([snapshot_filename(self.snapshot_path, self.operatingsystem)]), True
+        fingerprint = file_fingerprint(data_filenames(self.datapath, self.operatingsystem))
+        # a file rewritten within the resolution of its mtime keeps its fingerprint
+        trusted = all(entry is None or entry[2] < now - RACY_INTERVAL for entry in fingerprint)
+        return fingerprint, trusted
+
+    # These run in a thread, as snapshots are memory mapped and cannot be handed over from another process
+
+    # Whether the data files still are the ones the current generation was loaded from
+    # Hashing the raw files is much cheaper than loading them, so it settles the
+    # fingerprints that cannot be trusted.
+    def is_unchanged(self, fingerprint: Tuple[Fingerprint, bool]) -> bool:
+        if not self.verify and fingerprint == self.fingerprint and fingerprint[1]:
+            return True
+        if self.follow or not (self.verify or fingerprint[0] == self.fingerprint[0]):
+            return False
+        try:
+            unchanged = source_hash(self.datapath, self.operatingsystem) == self.source
+        except FileNotFoundError:
+            return False
+        if unchanged:
+            self.fingerprint = fingerprint
+        return unchanged
+
+    def read_snapshot(self) -> Optional[LoadedData]:
+        filename = snapshot_filename(self.snapshot_path, self.operatingsystem)
+        try:
+            loaded = load_snapshot(filename, self.datapath, self.operatingsystem, verify=not self.follow)
+        except Exception as e:
+            log.err("Ignoring broken snapshot {} ({})".format(filename, e))
+            return None
+        if loaded is not None:
+            log.msg("Using snapshot {}".format(filename))
+        return loaded
+
+    def write_snapshot(self, loaded: LoadedData) -> None:
+        filename = snapshot_filename(self.snapshot_path, self.operatingsystem)
+        try:
+            write_snapshot(filename, loaded)
+            log.msg("Wrote snapshot {}".format(filename))
+        except Exception as e:
+            log.err("An Exception occurred while writing snapshot {} ({})".format(filename, e))
+
+    # Callbacks
+
+    def notify(self, _, path: filepath.FilePath, mask: int) -> None:
+        # data not requested yet, or evicted, is read on the next request anyway
+        if self.read_task is not None and path.basename() in self.watched:
+            log.msg("event {} on {}".format(', '.join(inotify.humanReadableMask(mask)), path.path))
+            self.scheduler.schedule(complete=not mask & inotify.IN_MODIFY)
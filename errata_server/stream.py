@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from typing import (
+    Iterable,
+    Iterator,
+)
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.http import Request
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+# Group JSON fragments of list items into chunks; their concatenation equals join_fragments(fragments)
+def iter_chunks(fragments: Iterable[bytes], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    chunk = [b'[']
+    size = 1
+    separator = b''
+    for fragment in fragments:
+        chunk.append(separator)
+        chunk.append(fragment)
+        separator = b', '
+        size += len(fragment) + 2
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b']')
+    yield b''.join(chunk)
+
+
+# Tracks the transport's flow control for a streamed response
+@implementer(IPushProducer)
+class StreamProducer:
+    def __init__(self) -> None:
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.stopped = False
+
+    def pauseProducing(self) -> None:
+        self.resumed.clear()
+
+    def resumeProducing(self) -> None:
+        self.resumed.set()
+
+    def stopProducing(self) -> None:
+        self.stopped = True
+        self.resumed.set()
+
+
+# Write the chunks to the request, waiting whenever the transport asks us to pause
+# Returns False if the connection was lost before all chunks were written.
+async def write_stream(request: Request, chunks: Iterable[bytes]) -> bool:
+    producer = StreamProducer()
+    request.registerProducer(producer, True)
+    try:
+        for chunk in chunks:
+            await producer.resumed.wait()
+            if producer.stopped:
+                return False
+            request.write(chunk)
+            # give other requests a chance between chunks
+            await asyncio.sleep(0)
+        return not producer.stopped
+    finally:
+        # a lost connection already detached the request from its channel
+        if not producer.stopped:
+            request.unregisterProducer()
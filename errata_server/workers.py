@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+from typing import (
+    Dict,
+    List,
+)
+
+from twisted.internet import protocol, reactor
+from twisted.internet.interfaces import IDelayedCall
+from twisted.python import log
+
+
+# workers ending within this many seconds after their start failed to start up
+STARTUP_PERIOD = 10.0
+# restarts after failed startups are delayed by this many seconds, doubling up to MAX_RESTART_DELAY
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+# the parent gives up after this many failed startups of a worker in a row
+MAX_STARTUP_FAILURES = 5
+
+
+# Serving processes sharing the listening socket of the parent
+#
+# The parent loads the data and writes the snapshots, but does not accept
+# connections itself. Every worker adopts the inherited socket and serves
+# from the snapshots. Workers that die are restarted until the parent shuts
+# down. Workers failing right after their start are restarted with a growing
+# delay, and if they keep failing, the parent stops, as nobody would accept
+# connections on its socket.
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool: 'WorkerPool', number: int) -> None:
+        self.pool = pool
+        self.number = number
+
+    def processEnded(self, reason) -> None:
+        self.pool.ended(self.number, reason)
+
+
+class WorkerPool:
+    def __init__(self, count: int, fd: int, args: List[str]) -> None:
+        self.count = count
+        self.fd = fd
+        self.args = args
+        self.processes: Dict[int, protocol.ProcessProtocol] = {}
+        self.started: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {}
+        self.restarts: Dict[int, IDelayedCall] = {}
+        self.stopping = False
+
+    def start(self) -> None:
+        for number in range(self.count):
+            self.spawn(number)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, number: int) -> None:
+        self.restarts.pop(number, None)
+        worker = WorkerProtocol(self, number)
+        args = [sys.executable, '-m', 'errata_server'] + self.args + ['--worker-fd', str(self.fd), '--worker-number', str(number)]
+        reactor.spawnProcess(worker, sys.executable, args=args, env=None, childFDs={0: 0, 1: 1, 2: 2, self.fd: self.fd})
+        self.processes[number] = worker
+        self.started[number] = time.monotonic()
+        log.msg("Started worker {} (pid {})".format(number, worker.transport.pid))
+
+    def ended(self, number: int, reason) -> None:
+        del self.processes[number]
+        if self.stopping:
+            return
+        if time.monotonic() - self.started[number] < STARTUP_PERIOD:
+            self.failures[number] = self.failures.get(number, 0) + 1
+        else:
+            self.failures[number] = 0
+        failures = self.failures[number]
+        if failures >= MAX_STARTUP_FAILURES:
+            log.err("Worker {} ended ({}) right after starting {} times in a row; giving up".format(number, reason.value, failures))
+            reactor.stop()
+            return
+        delay = min(RESTART_DELAY * 2 ** (failures - 1), MAX_RESTART_DELAY) if failures else 0
+        log.msg("Worker {} ended ({}); restarting in {:.0f}s".format(number, reason.value, delay))
+        self.restarts[number] = reactor.callLater(delay, self.spawn, number)
+
+    def stop(self) -> None:
+        self.stopping = True
+        for restart in self.restarts.values():
+            restart.cancel()
+        self.restarts.clear()
+        for worker in self.processes.values():
+            if worker.transport.pid is not None:
+                worker.transport.signalProcess('TERM')
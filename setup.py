@@ -19,12 +19,16 @@ setup(  # pragma: no cover
     ],
     install_requires=[
         'asyncio',
-        'aiofiles',
         'decorator',
         'click',
         'simplejson',
         'twisted',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'zstd': ['zstandard'],
+        'numpy': ['numpy'],
+    },
     entry_points='''
         [console_scripts]
         errata_server=errata_server:main
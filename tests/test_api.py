@@ -1,10 +1,34 @@
 import pytest
+import io
 import os
+import asyncio
+import zlib
+import hashlib
+import shutil
+import simplejson
 
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
 from unittest.mock import Mock
 
+from twisted.internet import inotify
+from twisted.python import filepath
+
+from benchmarks.generate import generate_config, generate_errata, write_dataset
 from errata_server.api_beta import Endpoint as BetaEndpoint
 from errata_server.api_v1 import Endpoint as V1Endpoint
+from errata_server.cache import ResponseCache
+from errata_server.encoding import ENCODERS, negotiate
+from errata_server.fragments import Retained, SerializedErratum, diff_errata
+from errata_server.index import ErrataIndex
+from errata_server.loader import iter_json_list, load_data, source_hash
+from errata_server.metrics import Metrics, render_metrics
+from errata_server.registry import DataStores
+from errata_server.scheduler import ReloadScheduler
+from errata_server.snapshot import load_snapshot, snapshot_filename, write_snapshot
+from errata_server.store import DataStore
+from errata_server.stream import iter_chunks
+from errata_server.workers import MAX_STARTUP_FAILURES, STARTUP_PERIOD, WorkerPool
 
 
 TEST_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -28,69 +52,630 @@ GET_DATA = \
     b'10]}]'
 
 
+def make_request(uri, etag_matches=False, accept_encoding=None):
+    request = Mock()
+    request.uri = uri
+    request.setETag.return_value = etag_matches
+    request.getHeader.side_effect = lambda name: accept_encoding if name == b'accept-encoding' else None
+    return request
+
+
+# a writable copy of the debian fixture data
+@pytest.fixture
+def datapath(tmp_path):
+    for name in ('debian_config.json', 'debian_errata.json'):
+        shutil.copy(os.path.join(TEST_DIR, 'fixtures', name), str(tmp_path / name))
+    yield tmp_path
+
+
 @pytest.fixture(params=(BetaEndpoint, V1Endpoint), ids=["beta", "v1"])
 def endpoint(request):
-    yield request.param('debian', os.path.join(TEST_DIR, 'fixtures'))
+    yield request.param(DataStore('debian', os.path.join(TEST_DIR, 'fixtures')))
 
 
 @pytest.mark.asyncio
 async def test_validate_config(endpoint):
-    await endpoint.read_task
-    assert endpoint.etag_base == b'abbd247d7efc27b5d2d487387aee289edb1bf26c043d3232a12f34a9f0c16ab5'
+    await endpoint.store.read_task
+    assert endpoint.store.current.etag_base == b'9f2e5c5ae87d83e690f457f1247c909033e64e757f1c6fbfd8fd50057cb6046b'
 
 
 @pytest.mark.asyncio
 async def test_get_no_data(endpoint):
-    await endpoint.read_task
-    endpoint.data = None
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=stretch'
-    request.setETag.return_value = False
+    await endpoint.store.read_task
+    endpoint.store.current = None
+    request = make_request(b'/dep/api/beta/debian?releases=stretch')
     await endpoint.get(request)
     request.write.assert_called_with(b'Service temporarily unavailable')
 
 
 @pytest.mark.asyncio
 async def test_get(endpoint):
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=stretch'
-    request.setETag.return_value = False
+    request = make_request(b'/dep/api/beta/debian?releases=stretch')
     await endpoint.get(request)
     request.write.assert_called_with(GET_DATA)
 
 
 @pytest.mark.asyncio
 async def test_get_with_alias(endpoint):
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=stretch/updates'
-    request.setETag.return_value = False
+    request = make_request(b'/dep/api/beta/debian?releases=stretch/updates')
     await endpoint.get(request)
     request.write.assert_called_with(GET_DATA)
 
 
 @pytest.mark.asyncio
 async def test_get_with_whitespace(endpoint):
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=blue, stretch'
-    request.setETag.return_value = False
+    request = make_request(b'/dep/api/beta/debian?releases=blue, stretch')
     await endpoint.get(request)
     request.write.assert_called_with(GET_DATA)
 
 
 @pytest.mark.asyncio
 async def test_get_invalid(endpoint):
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=blue'
-    request.setETag.return_value = False
+    request = make_request(b'/dep/api/beta/debian?releases=blue')
     await endpoint.get(request)
     request.write.assert_called_with(b'[]')
 
 
 @pytest.mark.asyncio
 async def test_get_etag(endpoint):
-    request = Mock()
-    request.uri = b'/dep/api/beta/debian?releases=stretch'
-    request.setETag.return_value = True
+    request = make_request(b'/dep/api/beta/debian?releases=stretch', etag_matches=True)
     await endpoint.get(request)
     request.write.assert_not_called()
-    request.setETag.assert_called_with(b'c45b9b107d88ae65b41e4fb186fe4e83e6df9e0005724dfdbc352ebfff1e56a8')
+    request.setETag.assert_called_with(b'dd84d9dd16db4b99bf145e7c27c337f9f86f75a0608f5964b73da0d4642a41d6')
+
+
+@pytest.mark.asyncio
+async def test_get_architectures(endpoint):
+    request = make_request(b'/dep/api/beta/debian?architectures=armeb')
+    await endpoint.get(request)
+    result = simplejson.loads(request.write.call_args[0][0])
+    assert [item['name'] for item in result] == ['DSA-2345-1']
+    assert result[0]['packages'] == [simplejson.loads(GET_DATA)[1]['packages'][1]]
+
+
+@pytest.mark.asyncio
+async def test_get_components(endpoint):
+    request = make_request(b'/dep/api/beta/debian?components=contrib')
+    await endpoint.get(request)
+    request.write.assert_called_with(b'[]')
+
+
+@pytest.mark.parametrize('vectorized', (True, False), ids=["vectorized", "postings"])
+def test_index_lookup(vectorized, monkeypatch):
+    if not vectorized:
+        monkeypatch.setattr('errata_server.index.numpy', None)
+    data = simplejson.loads(GET_DATA)
+    index = ErrataIndex(data)
+    assert len(index) == 3
+    assert index.lookup(None, None, None) is None
+    assert list(index.lookup({'stretch'}, {'main'}, {'all'})) == [(1, [1])]
+    assert list(index.lookup({'stretch'}, None, {'amd64'})) == [(0, [0]), (1, [0])]
+    assert list(index.lookup({'buster'}, None, None)) == []
+    assert list(index.lookup({'stretch'}, {'contrib'}, None)) == []
+    filter_sets = [({'stretch'}, {'main'}, {'all'}), (None, None, None), ({'stretch'}, None, {'amd64'}), ({'buster'}, None, None)]
+    assert [matches if matches is None else list(matches) for matches in index.lookup_many(filter_sets)] == [[(1, [1])], None, [(0, [0]), (1, [0])], []]
+    assert list(index.lookup(None, None, None, {'second-base-common'})) == [(1, [0, 1])]
+    assert list(index.lookup({'stretch'}, None, {'all'}, None, {'second-base', 'base-camp'})) == [(1, [1])]
+    assert list(index.lookup(None, None, None, {'libsecond-base'}, None, {'CVE-1000-1000000', 'CVE-0'})) == []
+    assert list(index.lookup_many([(None, None, None, None, None, {'CVE-1000-1000000'})])[0]) == [(0, [0])]
+    restored = ErrataIndex.restore(index.offsets, [list(values) for values in index.values], index.columns, index.keys)
+    assert list(restored.lookup(None, None, {'all', 'amd64'})) == [(0, [0]), (1, [0, 1])]
+
+
+@pytest.mark.asyncio
+async def test_get_by_key(endpoint, monkeypatch):
+    await endpoint.store.read_task
+    data = simplejson.loads(GET_DATA)
+    expectations = (
+        (b'/dep/api/v1/debian?packages=base-camp,other', [data[0]]),
+        (b'/dep/api/v1/debian?source_packages=second-base&architectures=armeb', [dict(data[1], packages=data[1]['packages'][1:])]),
+        (b'/dep/api/v1/debian?cves=CVE-1000-1000001&releases=buster', []),
+    )
+    for uri, expected in expectations:
+        request = make_request(uri)
+        await endpoint.get(request)
+        request.write.assert_called_with(simplejson.dumps(expected).encode('utf-8'))
+    # unknown keys resolve to the same filters, so they cannot grow the etags
+    for number in range(3):
+        await endpoint.get(make_request(b'/dep/api/v1/debian?cves=CVE-0-' + str(number).encode('utf-8')))
+    assert (None, None, None, None, None, frozenset()) in endpoint.store.current.etags
+    assert len(endpoint.store.current.etags) == len(expectations) + 1
+    # known keys are only memoized up to a bound
+    monkeypatch.setattr('errata_server.store.ETAGS_SIZE', 2)
+    for cve in ('CVE-1000-1000000', 'CVE-1000-1000001', 'CVE-1000-1000000,CVE-1000-1000001'):
+        await endpoint.get(make_request(b'/dep/api/v1/debian?cves=' + cve.encode('utf-8')))
+    assert list(endpoint.store.current.etags) == [
+        (None, None, None, None, None, frozenset({'CVE-1000-1000001'})),
+        (None, None, None, None, None, frozenset({'CVE-1000-1000000', 'CVE-1000-1000001'})),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_cached(endpoint):
+    await endpoint.store.read_task
+    for uri in (b'/dep/api/beta/debian?releases=stretch&components=main', b'/dep/api/beta/debian?components=main&releases=stretch/updates'):
+        request = make_request(uri)
+        await endpoint.get(request)
+        request.write.assert_called_with(GET_DATA)
+    assert (endpoint.store.cache.hits, endpoint.store.cache.misses) == (1, 1)
+
+
+def test_response_cache_eviction():
+    cache = ResponseCache(max_entries=2, max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'90')
+    assert cache.get('b') is None
+    assert len(cache) == 2
+    cache.put('d', b'12345')
+    assert cache.get('a') is None
+    assert cache.size == 7
+    cache.put('e', b'12345678901')
+    assert cache.get('e') is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+@pytest.mark.asyncio
+async def test_get_etag_canonical(endpoint):
+    await endpoint.store.read_task
+    etags = set()
+    for uri in (b'/dep/api/beta/debian?releases=stretch,buster', b'/dep/api/beta/debian?releases=buster, stretch/updates,blue'):
+        request = make_request(uri, etag_matches=True)
+        await endpoint.get(request)
+        etags.add(request.setETag.call_args[0][0])
+    assert len(etags) == 1
+    assert len(endpoint.store.current.etags) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_streamed(endpoint):
+    await endpoint.store.read_task
+    endpoint.stream_threshold = 1
+    request = make_request(b'/dep/api/beta/debian?releases=stretch')
+    await endpoint.get(request)
+    assert b''.join(call[0][0] for call in request.write.call_args_list) == GET_DATA
+    request.registerProducer.assert_called_once()
+    request.unregisterProducer.assert_called_once()
+    request.finish.assert_called_once()
+    assert len(endpoint.store.cache) == 0
+
+
+def test_iter_chunks():
+    fragments = [SerializedErratum(item).body for item in simplejson.loads(GET_DATA)]
+    chunks = list(iter_chunks(fragments, chunk_size=16))
+    assert len(chunks) == 3
+    assert b''.join(chunks) == GET_DATA
+    assert list(iter_chunks([])) == [b'[]']
+
+
+def test_serialized_erratum():
+    data = simplejson.loads(GET_DATA)
+    erratum = SerializedErratum(data[1])
+    assert erratum.name == 'DSA-2345-1'
+    assert len(erratum) == 2
+    assert erratum.render() == simplejson.dumps(data[1]).encode('utf-8')
+    data[1]['packages'] = data[1]['packages'][1:]
+    assert erratum.render([1]) == simplejson.dumps(data[1]).encode('utf-8')
+    item = dict(data[0], packages=[dict(data[0]['packages'][0], version=str(number)) for number in range(5)])
+    erratum = SerializedErratum(item)
+    for positions in ([0, 1, 3], [1, 2], [4], [0, 2, 4]):
+        expected = dict(item, packages=[item['packages'][position] for position in positions])
+        assert erratum.render(positions) == simplejson.dumps(expected).encode('utf-8')
+    assert len(SerializedErratum(dict(item, packages=[]))) == 0
+
+
+@pytest.mark.asyncio
+async def test_read_data_incremental(datapath):
+    endpoint = V1Endpoint(DataStore('debian', str(datapath)))
+    await endpoint.store.read_task
+    for uri in (b'/dep/api/v1/debian?architectures=armeb', b'/dep/api/v1/debian?releases=stretch'):
+        request = make_request(uri)
+        await endpoint.get(request)
+    unchanged = endpoint.store.current.data[1]
+    data = simplejson.loads(GET_DATA)
+    data[0]['severity'] = 'low'
+    (datapath / 'debian_errata.json').write_text(simplejson.dumps(data))
+    await endpoint.store.read_data()
+    assert endpoint.store.current.data[1] is unchanged
+    assert endpoint.store.current.data[0].body == simplejson.dumps(data[0]).encode('utf-8')
+    assert list(endpoint.store.cache.entries) == [((None, None, frozenset({'armeb', 'all'}), None, None, None), None)]
+    assert list(endpoint.store.current.etags) == [(None, None, frozenset({'armeb', 'all'}), None, None, None)]
+
+
+@pytest.mark.asyncio
+async def test_read_data_unnamed(datapath):
+    data = simplejson.loads(GET_DATA)
+    del data[0]['name']
+    (datapath / 'debian_errata.json').write_text(simplejson.dumps(data))
+    store = DataStore('debian', str(datapath))
+    await store.read_task
+    for severity in ('low', 'mild'):
+        data[1]['severity'] = severity
+        (datapath / 'debian_errata.json').write_text(simplejson.dumps(data))
+        await store.read_data()
+        assert [item.body for item in store.current.data] == [simplejson.dumps(item).encode('utf-8') for item in data]
+    # errata without a str name are never taken for unchanged ones
+    result, diff = diff_errata({'DSA-2345-1': store.current.data[1].digest}, [dict(data[1], name=['DSA-2345-1']), data[1]])
+    assert isinstance(result[0], SerializedErratum) and result[1] == Retained(0)
+
+
+def test_diff_errata():
+    data = simplejson.loads(GET_DATA)
+    old = [SerializedErratum(item) for item in data]
+    digests = {item.name: item.digest for item in old}
+    data.append(dict(data[0], name='DSA-3456-1'))
+    del data[0]
+    result, diff = diff_errata(digests, data)
+    assert result[0] == Retained(1)
+    assert isinstance(result[1], SerializedErratum)
+    assert (diff.added, diff.changed, diff.removed, diff.unchanged) == (1, 0, 1, 1)
+    assert diff.previous == ['DSA-1234-1']
+    diff.add_previous(old[0])
+    assert diff.targets == {('stretch', 'main', 'amd64')}
+    assert diff.affects((None, None, None))
+    assert not diff.affects((frozenset({'buster'}), None, None))
+    _, diff = diff_errata(digests, list(reversed(simplejson.loads(GET_DATA))))
+    assert not diff.incremental
+
+
+def test_load_data_in_process():
+    with ProcessPoolExecutor(1) as executor:
+        loaded = executor.submit(load_data, os.path.join(TEST_DIR, 'fixtures'), 'debian').result()
+    assert loaded.etag_base == '9f2e5c5ae87d83e690f457f1247c909033e64e757f1c6fbfd8fd50057cb6046b'
+    assert [item.body for item in loaded.resolve(None)] == [simplejson.dumps(item).encode('utf-8') for item in simplejson.loads(GET_DATA)]
+    assert loaded.release_aliases['stretch/updates'] == 'stretch'
+    assert set(loaded.timings) == {'read config', 'read errata', 'validate', 'serialize', 'index'}
+
+
+@pytest.mark.asyncio
+async def test_read_data_snapshot(tmp_path):
+    endpoint = V1Endpoint(DataStore('debian', os.path.join(TEST_DIR, 'fixtures'), snapshot_path=str(tmp_path)))
+    await endpoint.store.read_task
+    assert (tmp_path / 'debian_errata.snapshot').exists()
+    endpoint = V1Endpoint(DataStore('debian', os.path.join(TEST_DIR, 'fixtures'), snapshot_path=str(tmp_path)))
+    await endpoint.store.read_task
+    assert 'read snapshot' in endpoint.store.timings
+    assert isinstance(endpoint.store.current.data[0].body, memoryview)
+    assert isinstance(endpoint.store.current.index.columns[0], memoryview)
+    assert [item.issued for item in endpoint.store.current.data] == [date(1000, 1, 1).toordinal(), date(1000, 1, 2).toordinal()]
+    assert endpoint.store.current.etag_base == b'9f2e5c5ae87d83e690f457f1247c909033e64e757f1c6fbfd8fd50057cb6046b'
+    assert endpoint.store.current.release_aliases['stretch/updates'] == 'stretch'
+    partial = simplejson.loads(GET_DATA)[1]
+    del partial['packages'][0]
+    expectations = (
+        (b'/dep/api/v1/debian?releases=stretch', GET_DATA),
+        (b'/dep/api/v1/debian?architectures=ppc64', simplejson.dumps([partial]).encode('utf-8')),
+        (b'/dep/api/v1/debian?cves=CVE-1000-1000001&architectures=ppc64', simplejson.dumps([partial]).encode('utf-8')),
+    )
+    for uri, expected in expectations:
+        request = make_request(uri)
+        await endpoint.get(request)
+        request.write.assert_called_with(expected)
+
+
+@pytest.mark.asyncio
+async def test_read_data_snapshot_read_only(tmp_path):
+    store = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'), snapshot_path=str(tmp_path), write_snapshots=False)
+    await store.read_task
+    assert store.current.number == 1
+    assert not (tmp_path / 'debian_errata.snapshot').exists()
+
+
+def test_load_snapshot_stale(datapath):
+    filename = snapshot_filename(str(datapath), 'debian')
+    assert load_snapshot(filename, str(datapath), 'debian') is None
+    write_snapshot(filename, load_data(str(datapath), 'debian'))
+    assert load_snapshot(filename, str(datapath), 'debian').source == source_hash(str(datapath), 'debian')
+    (datapath / 'debian_errata.json').write_text('[]')
+    assert load_snapshot(filename, str(datapath), 'debian') is None
+
+
+@pytest.mark.asyncio
+async def test_shared_store():
+    store = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'))
+    for endpoint in (BetaEndpoint(store), V1Endpoint(store)):
+        request = make_request(b'/dep/api/beta/debian?releases=stretch')
+        await endpoint.get(request)
+        request.write.assert_called_with(GET_DATA)
+    assert (store.cache.hits, store.cache.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_follower_store(tmp_path):
+    follower = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'), snapshot_path=str(tmp_path), follow=True)
+    await follower.read_task
+    assert follower.current is None
+    leader = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'), snapshot_path=str(tmp_path))
+    await leader.read_task
+    await follower.read_data()
+    assert follower.current.etag_base == leader.current.etag_base
+    assert [bytes(item.body) for item in follower.current.data] == [bytes(item.body) for item in leader.current.data]
+
+
+@pytest.mark.asyncio
+async def test_get_gzip(endpoint):
+    await endpoint.store.read_task
+    for _ in range(2):
+        request = make_request(b'/dep/api/beta/debian?releases=stretch', accept_encoding=b'br;q=0, gzip')
+        await endpoint.get(request)
+        assert zlib.decompress(request.write.call_args[0][0], 31) == GET_DATA
+        request.setHeader.assert_any_call(b'content-encoding', b'gzip')
+        request.setETag.assert_called_with(b'dd84d9dd16db4b99bf145e7c27c337f9f86f75a0608f5964b73da0d4642a41d6-gzip')
+    assert (endpoint.store.cache.hits, endpoint.store.cache.misses) == (1, 1)
+
+
+def test_negotiate():
+    assert negotiate(None) is None
+    assert negotiate(b'identity') is None
+    assert negotiate(b'gzip;q=0') is None
+    assert negotiate(b'GZip, deflate') == b'gzip'
+    assert negotiate(b'*') == next(iter(ENCODERS))
+
+
+@pytest.mark.asyncio
+async def test_get_since(datapath):
+    endpoint = V1Endpoint(DataStore('debian', str(datapath)))
+    await endpoint.store.read_task
+    version = endpoint.store.current.etag_base
+    data = simplejson.loads(GET_DATA)
+    data[1]['severity'] = 'low'
+    (datapath / 'debian_errata.json').write_text(simplejson.dumps(data))
+    await endpoint.store.read_data()
+    expectations = (
+        (b'/dep/api/v1/debian?since=' + version, simplejson.dumps(data[1:]).encode('utf-8')),
+        (b'/dep/api/v1/debian?since=' + endpoint.store.current.etag_base, b'[]'),
+        (b'/dep/api/v1/debian?since=1000-01-02', simplejson.dumps(data[1:]).encode('utf-8')),
+        (b'/dep/api/v1/debian?since=unknown', simplejson.dumps(data).encode('utf-8')),
+    )
+    for uri, expected in expectations:
+        request = make_request(uri)
+        await endpoint.get(request)
+        request.setHeader.assert_any_call(b'x-data-version', endpoint.store.current.etag_base)
+        request.write.assert_called_with(expected)
+    assert list(endpoint.store.cache.entries) == [((None, None, None, None, None, None), None)]
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+    metrics = Metrics()
+    store = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'))
+    endpoint = V1Endpoint(store, metrics=metrics.endpoint('v1', 'debian'))
+    for etag_matches in (False, True):
+        request = make_request(b'/dep/api/v1/debian?releases=stretch', etag_matches)
+        await endpoint.get(request)
+    lines = render_metrics(metrics, {'debian': store}).decode('utf-8').splitlines()
+    assert 'errata_requests_total{api="v1",operatingsystem="debian",code="200"} 1' in lines
+    assert 'errata_requests_total{api="v1",operatingsystem="debian",code="304"} 1' in lines
+    assert 'errata_request_phase_seconds_count{api="v1",operatingsystem="debian",phase="filter"} 1' in lines
+    assert 'errata_response_bytes_count{api="v1",operatingsystem="debian"} 1' in lines
+    assert 'errata_response_bytes_sum{api="v1",operatingsystem="debian"} ' + repr(float(len(GET_DATA))) in lines
+    assert 'errata_errata{operatingsystem="debian"} 2' in lines
+    assert 'errata_packages{operatingsystem="debian"} 3' in lines
+    assert 'errata_cache_misses_total{operatingsystem="debian"} 1' in lines
+    assert any(line.startswith('errata_reload_stage_seconds{operatingsystem="debian",stage="pivot"} ') for line in lines)
+    # the samples of every family directly follow its header
+    family = None
+    for line in lines:
+        if line.startswith('# TYPE '):
+            family = line.split()[2]
+        elif not line.startswith('#'):
+            assert line.split('{')[0].split()[0] in (family, family + '_bucket', family + '_sum', family + '_count')
+    # workers label their metrics
+    metrics = Metrics((('worker', '1'),))
+    metrics.endpoint('v1', 'debian').observe_request(200)
+    lines = render_metrics(metrics, {'debian': store}).decode('utf-8').splitlines()
+    assert 'errata_requests_total{worker="1",api="v1",operatingsystem="debian",code="200"} 1' in lines
+    assert 'errata_errata{worker="1",operatingsystem="debian"} 2' in lines
+
+
+def test_benchmark_dataset(tmp_path):
+    errata = write_dataset(str(tmp_path), 'debian', 50, releases=3, architectures=2, seed=1)
+    assert errata == generate_errata(50, generate_config(3, 2), seed=1)
+    loaded = load_data(str(tmp_path), 'debian')
+    assert len(loaded.resolve(None)) == 50
+    assert loaded.release_aliases['release2/updates'] == 'release2'
+    assert loaded.architectures == {'all', 'amd64', 'i386'}
+
+
+def test_iter_json_list(tmp_path):
+    filename = str(tmp_path / 'list.json')
+    for text in (' [ ]\n', '[1, 22 ,333]', '[{"a": "ü€\U0001d11e", "b": [1.5e3, true, null]}, {"c": "x"}]\n'):
+        (tmp_path / 'list.json').write_text(text, encoding='utf-8')
+        for chunk_size in (1, 3, 1024):
+            hasher = hashlib.sha256()
+            assert list(iter_json_list(filename, hasher, chunk_size)) == simplejson.loads(text)
+            assert hasher.digest() == hashlib.sha256(text.encode('utf-8')).digest()
+    for text in ('{}', '[1 2]', '[1,]', '[1] 2', '[{"a": 1}'):
+        (tmp_path / 'list.json').write_text(text)
+        with pytest.raises((AssertionError, simplejson.JSONDecodeError)):
+            list(iter_json_list(filename, chunk_size=2))
+
+
+@pytest.mark.asyncio
+async def test_get_coalesced(endpoint):
+    await endpoint.store.read_task
+    requests = [make_request(b'/dep/api/v1/debian?releases=stretch', accept_encoding=b'gzip') for _ in range(3)]
+    await asyncio.gather(*(endpoint.get(request) for request in requests))
+    for request in requests:
+        request.write.assert_called_with(ENCODERS[b'gzip'](GET_DATA))
+    assert endpoint.metrics.coalesced == 2
+    assert endpoint.metrics.phases['serialize'].count == 1
+    assert len(endpoint.store.flights) == 0
+
+
+@pytest.mark.asyncio
+async def test_generation_pinned(datapath):
+    endpoint = V1Endpoint(DataStore('debian', str(datapath)))
+    await endpoint.store.read_task
+    pinned = endpoint.store.current
+    filters = pinned.resolve_filters({})
+    data = simplejson.loads(GET_DATA)
+    (datapath / 'debian_errata.json').write_text(simplejson.dumps(data[1:]))
+    await endpoint.store.read_data()
+    assert endpoint.store.current is not pinned
+    assert endpoint.store.current.number == pinned.number + 1
+    assert await endpoint.start(pinned, filters, None, None) == GET_DATA
+    assert len(endpoint.store.cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_read_data_unchanged(datapath, monkeypatch):
+    store = DataStore('debian', str(datapath))
+    await store.read_task
+    # just written, so the content is compared
+    await store.read_data()
+    assert (store.current.number, store.skipped_reloads) == (1, 1)
+    # once old enough, the fingerprint alone is trusted
+    for name in ('debian_config.json', 'debian_errata.json'):
+        os.utime(str(datapath / name), (1000000000, 1000000000))
+    await store.read_data()
+    monkeypatch.setattr('errata_server.store.source_hash', None)
+    await store.read_data()
+    assert (store.current.number, store.skipped_reloads) == (2, 2)
+    monkeypatch.undo()
+    # a change keeping size and mtime is only noticed when verifying the content
+    errata = str(datapath / 'debian_errata.json')
+    with open(errata, 'r+b') as fd:
+        changed = fd.read().replace(b'"severity": "high"', b'"severity": "mild"')
+        fd.seek(0)
+        fd.write(changed)
+    os.utime(errata, (1000000000, 1000000000))
+    await store.read_data()
+    assert (store.current.number, store.skipped_reloads) == (2, 3)
+    store.verify = True
+    await store.read_data()
+    assert store.current.number == 3
+
+
+@pytest.mark.asyncio
+async def test_reload_scheduler():
+    started = []
+    release = asyncio.Event()
+
+    async def reload():
+        started.append(asyncio.get_event_loop().time())
+        await release.wait()
+
+    scheduler = ReloadScheduler(reload, delay=0.01, settle_delay=0.05)
+    # a burst of events starts a single reload, once the files are complete
+    for complete in (False, True, False, True):
+        scheduler.schedule(complete)
+    await asyncio.sleep(0.03)
+    assert len(started) == 1
+    # events during a reload queue only one more
+    for _ in range(3):
+        scheduler.schedule()
+        await asyncio.sleep(0.02)
+    assert len(started) == 1 and scheduler.queued
+    release.set()
+    await asyncio.sleep(0.01)
+    assert len(started) == 2 and not scheduler.queued
+    # a file modified without being closed needs to settle first
+    scheduler.schedule(complete=False)
+    await asyncio.sleep(0.03)
+    assert len(started) == 2
+    await asyncio.sleep(0.05)
+    assert len(started) == 3
+
+
+@pytest.mark.asyncio
+async def test_notify_data_files():
+    store = DataStore('debian', os.path.join(TEST_DIR, 'fixtures'))
+    store.scheduler = Mock()
+    await store.read_task
+    events = (
+        (b'debian_errata.json', inotify.IN_CLOSE_WRITE),
+        (b'debian_config.json', inotify.IN_MODIFY),
+        (b'ubuntu_errata.json', inotify.IN_CLOSE_WRITE),
+        (b'.snapshot1234', inotify.IN_MOVED_TO),
+    )
+    for name, mask in events:
+        store.notify(None, Mock(basename=Mock(return_value=name), path=name), mask)
+    assert store.scheduler.schedule.call_args_list == [((), {'complete': True}), ((), {'complete': False})]
+
+
+@pytest.mark.asyncio
+async def test_data_stores(datapath):
+    stores = DataStores(str(datapath), {}, idle_timeout=3600)
+    assert stores.operatingsystems == {'debian'}
+    assert stores.stores == {}
+    assert stores.get('ubuntu') is None
+    store = stores.get('debian')
+    assert (await store.wait_ready(timeout=30)).number == 1
+    # operating systems appearing later are served once their config file is complete
+    for kind in ('errata', 'config'):
+        (datapath / 'ubuntu_{}.json'.format(kind)).write_bytes((datapath / 'debian_{}.json'.format(kind)).read_bytes())
+    stores.notify(None, filepath.FilePath(str(datapath / 'ubuntu_config.json')).asBytesMode(), inotify.IN_CLOSE_WRITE)
+    assert stores.get('ubuntu') is not None
+    # idle data is dropped, and read again on the next request
+    store.last_used -= 3600
+    stores.evict_idle()
+    assert (store.current, store.evictions) == (None, 1)
+    assert stores.stores['ubuntu'].evictions == 0
+    assert (await store.wait_ready(timeout=30)).number == 2
+
+
+@pytest.mark.asyncio
+async def test_data_stores_evict_pending_reload(datapath):
+    stores = DataStores(str(datapath), {'reload_delay': 0.01}, idle_timeout=3600)
+    store = stores.get('debian')
+    await store.wait_ready(timeout=30)
+    errata = filepath.FilePath(str(datapath / 'debian_errata.json')).asBytesMode()
+    # data with a pending reload is kept, so later changes are still picked up
+    stores.notify(None, errata, inotify.IN_CLOSE_WRITE)
+    assert not store.evict()
+    await asyncio.sleep(0.05)
+    data = simplejson.loads(GET_DATA)
+    data[0]['severity'] = 'low'
+    (datapath / 'debian_errata.json').write_text(simplejson.dumps(data))
+    stores.notify(None, errata, inotify.IN_CLOSE_WRITE)
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if store.current.number == 2:
+            break
+    assert store.current.data[0].body == simplejson.dumps(data[0]).encode('utf-8')
+    assert store.evict()
+
+
+@pytest.mark.asyncio
+async def test_post_batch(endpoint):
+    await endpoint.store.read_task
+    data = simplejson.loads(GET_DATA)
+    batch = [{'releases': ['stretch']}, {'releases': 'stretch', 'architectures': ['armeb']}, {'releases': ['stretch,stretch/updates']}, {'components': []}]
+    request = make_request(b'/dep/api/v1/debian/batch')
+    request.postpath = [b'batch']
+    request.content = io.BytesIO(simplejson.dumps(batch).encode('utf-8'))
+    await endpoint.post(request)
+    response = simplejson.loads(request.write.call_args[0][0])
+    data[1]['packages'] = data[1]['packages'][1:]
+    assert response == {'errata': simplejson.loads(GET_DATA) + [data[1]], 'results': [[0, 1], [2], [0, 1], []]}
+    for postpath, body in (([b'batch'], b'[{"release": ["stretch"]}]'), ([b'batch'], b'{}'), ([], b'[]')):
+        request = make_request(b'/dep/api/v1/debian')
+        request.postpath = postpath
+        request.content = io.BytesIO(body)
+        await endpoint.post(request)
+        request.setResponseCode.assert_called_with(400 if postpath else 404)
+
+
+def test_worker_restarts(monkeypatch):
+    reactor = Mock()
+    reactor.spawnProcess.side_effect = lambda worker, *args, **kwargs: worker.makeConnection(Mock(pid=1234))
+    monkeypatch.setattr('errata_server.workers.reactor', reactor)
+    clock = Mock(return_value=1000.0)
+    monkeypatch.setattr('errata_server.workers.time.monotonic', clock)
+    pool = WorkerPool(1, 3, [])
+    pool.start()
+    # a worker that served for a while is restarted right away
+    clock.return_value += STARTUP_PERIOD
+    pool.ended(0, Mock())
+    assert reactor.callLater.call_args[0] == (0, pool.spawn, 0)
+    pool.spawn(0)
+    # workers failing at startup are restarted with a growing delay, until the parent gives up
+    for failures in range(1, MAX_STARTUP_FAILURES):
+        pool.ended(0, Mock())
+        assert reactor.callLater.call_args[0] == (2 ** (failures - 1), pool.spawn, 0)
+        pool.spawn(0)
+    assert not reactor.stop.called
+    pool.ended(0, Mock())
+    assert reactor.stop.called